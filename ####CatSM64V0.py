@@ -1,13 +1,37 @@
 # sm64v0.py — Full SM64 port: all HackerSM64-style codebase in one file
 # 3D engine, camera, physics, graphics, title menu, file select, game loop. Python 3.14+.
 
+import argparse
+import json
 import math
-import pygame
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import count
+from multiprocessing import shared_memory
+from operator import itemgetter
+
+try:
+    import pygame
+except ImportError:
+    pygame = None  # headless simulation (step(), SimBatch) still works without it
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # --- Configuration (1:1 SM64-style) ---
 W, H = 960, 720
 FOV = 52
 NEAR, FAR = 0.1, 1000
+GUARD_BAND = 4000  # px beyond the viewport that near-clipped polygons are cut to
 CAM_SPEED = 16.0
 CAM_TURN = 0.0022
 CAM_DISTANCE = 26.0
@@ -16,7 +40,44 @@ PITCH_MAX = 0.92
 GRAVITY = -42.0
 JUMP_VELOCITY = 14.0
 GROUND_Y = 1.0
+MARIO_SPAWN = (0.0, GROUND_Y, 6.0)
+MARIO_RADIUS = 0.35
+MARIO_HALF_HEIGHT = 0.375  # target_pos is the body centre; feet are this far below it
+MARIO_HEAD = 1.15  # top of the head above target_pos
+STEP_HEIGHT = 0.3
+KILL_Y = -40.0
+COLLISION_CELL = 8.0
+LEVEL_CHUNK = 240.0  # world units per streamed level chunk (one castle tile)
+STREAM_RADIUS = 720.0  # chunks whose AABB is this close to Mario are kept resident
+STREAM_BUDGET = 64 << 20  # resident bytes for streamed chunks
+STREAM_REPLAN = 60.0  # world units Mario moves inside one chunk cell before the loader re-plans
+TERRAIN = False  # heightmapped quadtree terrain instead of get_castle_scene()'s flat ground slabs
+TERRAIN_CELLS = 256  # heightmap cells per side (a power of two)
+TERRAIN_SPACING = 4.0  # world units per heightmap cell
+TERRAIN_LEAF = 4  # quads per side of every rendered terrain chunk, whatever its LOD
+TERRAIN_LOD = 1.5  # split a chunk while the camera is within this many chunk widths (>= 1.5 keeps
+                   # neighbouring chunks within one LOD of each other)
+TERRAIN_CACHE = 1024  # terrain chunk geometries kept (LRU); several selections' worth
+TERRAIN_SNAP = 8.0  # LOD is picked from the camera position rounded to this grid (world units)
+SIM_HZ = 120  # fixed simulation rate, independent of the render rate
+MAX_SIM_STEPS = 8  # frame-skip limit: sim steps per rendered frame before time is dropped
 VERSION = "v0.2.1 (Fixed & Enhanced)"
+USE_NUMPY = True  # batched vertex transform; False (or no NumPy) uses per-vertex to_view()/project_view()
+RASTER_BACKEND = "polygon"  # "polygon" (painter's sort + pygame.draw) or "zbuffer" (NumPy depth buffer)
+RENDER_WORKERS = 0  # >0: z-buffer row bands (and, without a GIL, per-mesh transforms) run on this many workers
+FRAME_COHERENCE = True  # re-present the last 3D image while camera, actors and window are unchanged
+IMPOSTORS = True  # draw distant level objects as cached sprites instead of triangles
+IMPOSTOR_DISTANCE = 120.0  # an object's bounding sphere must be at least this far from the camera
+IMPOSTOR_MAX_SIZE = 0.05  # ... and its radius at most this fraction of its distance (big slabs stay geometry)
+IMPOSTOR_ANGLE = 0.06  # radians of view yaw/pitch per sprite; drifting past a step re-bakes
+IMPOSTOR_CACHE = 16 << 20  # bytes of sprite pixels kept (LRU)
+IMPOSTOR_KEY = (255, 0, 255)  # transparent colour of impostor sprites
+SAVE_DIR = "saves"  # one slotN.sav per file select slot
+AUTOSAVE_INTERVAL = 10.0  # seconds of play between autosaves
+DYNAMIC_RESOLUTION = True  # render the 3D pass below native size when frames run over FRAME_BUDGET
+FRAME_BUDGET = 1.0 / 60  # seconds of work per frame the resolution controller aims for
+RENDER_SCALE_MIN = 0.5
+RENDER_SCALE_STEP = 0.05  # the 3D scale moves in these steps so offscreen buffers get reused
 
 def orbit_camera_pos(target, yaw, pitch, distance):
     cp = math.cos(pitch)
@@ -25,41 +86,760 @@ def orbit_camera_pos(target, yaw, pitch, distance):
     sz = math.cos(yaw) * cp
     return [target[0] + distance * sx, target[1] + distance * sy, target[2] + distance * sz]
 
-def project(v, cam_pos, cam_rot, scale=1.0):
+def to_view(v, cam_pos, cam_rot):
+    """World point to view space: x right, y up, z depth along the view direction."""
     x, y, z = v[0] - cam_pos[0], v[1] - cam_pos[1], v[2] - cam_pos[2]
     cy, sy = math.cos(cam_rot[1]), math.sin(cam_rot[1])
     x, z = x * cy + z * sy, -x * sy + z * cy
     cx, sx = math.cos(cam_rot[0]), math.sin(cam_rot[0])
     y, z = y * cx - z * sx, y * sx + z * cx
-    if z <= NEAR:
-        return None
+    return (x, y, z)
+
+def project_view(p, scale=1.0):
+    """View-space point (z > 0) to (screen x, screen y, depth); scale sizes the result for a
+    W*scale x H*scale render target."""
+    x, y, z = p
     f = (W * 0.5) / math.tan(math.radians(FOV * 0.5)) / z * scale
-    return (W * 0.5 + x * f, H * 0.5 - y * f, z)
+    return (W * 0.5 * scale + x * f, H * 0.5 * scale - y * f, z)
 
-def draw_tri(surf, pts, color, cam_pos, cam_rot):
-    proj = []
-    for p in pts:
-        q = project(p, cam_pos, cam_rot)
-        if q is None:
-            return
-        proj.append(q)
-    a, b, c = pts[0], pts[1], pts[2]
+def clip_near(a, b, c):
+    """Clip a view-space triangle to z >= NEAR; returns the polygon left (0, 3 or 4 points)."""
+    poly = []
+    for p, q in ((a, b), (b, c), (c, a)):
+        if p[2] >= NEAR:
+            poly.append(p)
+        if (p[2] >= NEAR) != (q[2] >= NEAR):
+            t = (NEAR - p[2]) / (q[2] - p[2])
+            poly.append((p[0] + (q[0] - p[0]) * t, p[1] + (q[1] - p[1]) * t, NEAR))
+    return poly if len(poly) >= 3 else []
+
+def clip_guard_band(poly, w, h):
+    """Cut a projected polygon [(x, y, depth)] to a w x h viewport plus GUARD_BAND pixels on
+    each side. pygame.draw.polygon's cost follows a polygon's extent, not its visible area,
+    and a triangle clipped at NEAR can reach hundreds of thousands of pixels. New vertices
+    interpolate 1/depth, which is linear on screen."""
+    for axis, bound, upper in ((0, -GUARD_BAND, False), (0, w + GUARD_BAND, True),
+                               (1, -GUARD_BAND, False), (1, h + GUARD_BAND, True)):
+        if len(poly) < 3:
+            return []
+        out = []
+        prev = poly[-1]
+        prev_in = prev[axis] <= bound if upper else prev[axis] >= bound
+        for p in poly:
+            p_in = p[axis] <= bound if upper else p[axis] >= bound
+            if p_in != prev_in:
+                t = (bound - prev[axis]) / (p[axis] - prev[axis])
+                iz = 1.0 / prev[2] + (1.0 / p[2] - 1.0 / prev[2]) * t
+                out.append((prev[0] + (p[0] - prev[0]) * t, prev[1] + (p[1] - prev[1]) * t, 1.0 / iz))
+            if p_in:
+                out.append(p)
+            prev, prev_in = p, p_in
+        poly = out
+    return poly if len(poly) >= 3 else []
+
+def queue_clipped(to_draw, a, b, c, fill, edge, scale=1.0):
+    """Queue a view-space triangle that crosses NEAR as the 1 or 2 triangles in front of it,
+    each cut to the guard band and queued as one convex polygon. The pieces keep their
+    triangle's sort depth, so the painter's order is the same as without the cut."""
+    poly = [project_view(p, scale) for p in clip_near(a, b, c)]
+    for i in range(1, len(poly) - 1):
+        tri = (poly[0], poly[i], poly[i + 1])
+        piece = clip_guard_band(tri, W * scale, H * scale)
+        if piece:
+            to_draw.append(((tri[0][2] + tri[1][2] + tri[2][2]) / 3, [p[:2] for p in piece],
+                            fill, edge, tuple(p[2] for p in piece)))
+
+def face_normal(a, b, c):
     ab = (b[0]-a[0], b[1]-a[1], b[2]-a[2])
     ac = (c[0]-a[0], c[1]-a[1], c[2]-a[2])
-    nx = ab[1]*ac[2] - ab[2]*ac[1]
-    ny = ab[2]*ac[0] - ab[0]*ac[2]
-    nz = ab[0]*ac[1] - ab[1]*ac[0]
-    view = (cam_pos[0]-a[0], cam_pos[1]-a[1], cam_pos[2]-a[2])
-    if nx*view[0] + ny*view[1] + nz*view[2] <= 0:
-        return
-    ps = [(p[0], p[1]) for p in proj]
+    return (ab[1]*ac[2] - ab[2]*ac[1], ab[2]*ac[0] - ab[0]*ac[2], ab[0]*ac[1] - ab[1]*ac[0])
+
+def shade_colors(color, nz):
     nz = max(-1, min(1, nz * 0.01))
     shade = max(0.35, min(1.0, 0.65 + nz))
     r = int(min(255, color[0] * shade))
     g = int(min(255, color[1] * shade))
     b = int(min(255, color[2] * shade))
-    pygame.draw.polygon(surf, (r, g, b), ps)
-    pygame.draw.polygon(surf, (min(255, r+35), min(255, g+35), min(255, b+35)), ps, 1)
+    return (r, g, b), (min(255, r+35), min(255, g+35), min(255, b+35))
+
+# --- Compiled meshes ---
+_mesh_ids = count()
+
+class Mesh:
+    """Indexed triangles: shared vertices plus per-face normal, plane offset and shaded colours.
+
+    Arrays are NumPy when the batched vertex stage is on, plain lists otherwise. Each source
+    scene entry becomes an object owning a contiguous vertex and triangle range, with an AABB
+    in `bounds` and a BVH over those boxes for frustum culling.
+    """
+
+    def __init__(self, verts, tris, normals, plane_d, fills, edges, objects, bounds, bvh=None):
+        self.verts = verts
+        self.tris = tris
+        self.normals = normals
+        self.plane_d = plane_d
+        self.fills = fills
+        self.edges = edges
+        self.objects = objects
+        self.bounds = bounds
+        self.bvh = build_bvh(bounds) if bvh is None else bvh
+        self.vectorised = np is not None and not isinstance(verts, list)
+        self.uid = next(_mesh_ids)  # stable cache key, unlike id() of a streamed-out mesh
+
+def compile_mesh(scene):
+    """Weld each (tri_list, color) entry of a scene into one Mesh, baking normals and flat shade."""
+    verts, tris, normals, plane_d, fills, edges = [], [], [], [], [], []
+    objects, bounds = [], []
+    for tri_list, color in scene:
+        index = {}
+        v0, t0 = len(verts), len(tris)
+        for tri in tri_list:
+            ids = []
+            for p in tri:
+                i = index.get(p)
+                if i is None:
+                    i = index[p] = len(verts)
+                    verts.append(p)
+                ids.append(i)
+            n = face_normal(*tri)
+            fill, edge = shade_colors(color, n[2])
+            tris.append(tuple(ids))
+            normals.append(n)
+            plane_d.append(n[0]*tri[0][0] + n[1]*tri[0][1] + n[2]*tri[0][2])
+            fills.append(fill)
+            edges.append(edge)
+        if len(verts) == v0:
+            continue
+        objects.append((v0, len(verts), t0, len(tris)))
+        own = verts[v0:]
+        bounds.append((tuple(min(p[a] for p in own) for a in range(3)), tuple(max(p[a] for p in own) for a in range(3))))
+    if USE_NUMPY and np is not None:
+        return Mesh(np.array(verts, dtype=np.float32).reshape(-1, 3), np.array(tris, dtype=np.int32).reshape(-1, 3),
+                    np.array(normals, dtype=np.float32).reshape(-1, 3), np.array(plane_d, dtype=np.float32),
+                    fills, edges, objects, bounds)
+    return Mesh(verts, tris, normals, plane_d, fills, edges, objects, bounds)
+
+# --- Frustum culling (BVH over object AABBs) ---
+BVH_LEAF_SIZE = 4
+
+def build_bvh(bounds):
+    """Median-split BVH; nodes are (min, max, left, right, items), leaves have left == -1."""
+    nodes = []
+
+    def build(items):
+        mn = tuple(min(bounds[i][0][a] for i in items) for a in range(3))
+        mx = tuple(max(bounds[i][1][a] for i in items) for a in range(3))
+        node = len(nodes)
+        nodes.append(None)
+        if len(items) <= BVH_LEAF_SIZE:
+            nodes[node] = (mn, mx, -1, -1, items)
+            return node
+        axis = max(range(3), key=lambda a: mx[a] - mn[a])
+        items = sorted(items, key=lambda i: bounds[i][0][axis] + bounds[i][1][axis])
+        mid = len(items) // 2
+        left = build(items[:mid])
+        right = build(items[mid:])
+        nodes[node] = (mn, mx, left, right, items)
+        return node
+
+    if bounds:
+        build(list(range(len(bounds))))
+    return nodes
+
+def camera_axes(cam_rot):
+    """World-space right, up and forward vectors of the view used by to_view()."""
+    cy, sy = math.cos(cam_rot[1]), math.sin(cam_rot[1])
+    cx, sx = math.cos(cam_rot[0]), math.sin(cam_rot[0])
+    return (cy, 0.0, sy), (sy * sx, cx, -cy * sx), (-sy * cx, sx, cy * cx)
+
+def view_frustum(cam_pos, cam_rot):
+    """Inward planes (nx, ny, nz, d) for left/right/bottom/top/near/far; inside means n.p + d >= 0."""
+    right, up, fwd = camera_axes(cam_rot)
+    th = math.tan(math.radians(FOV * 0.5))
+    tv = th * H / max(1, W)
+    planes = []
+    for (a, b, c), d in (((1, 0, th), 0.0), ((-1, 0, th), 0.0), ((0, 1, tv), 0.0), ((0, -1, tv), 0.0),
+                         ((0, 0, 1), -NEAR), ((0, 0, -1), FAR)):
+        n = tuple(a * right[i] + b * up[i] + c * fwd[i] for i in range(3))
+        planes.append((n[0], n[1], n[2], d - (n[0]*cam_pos[0] + n[1]*cam_pos[1] + n[2]*cam_pos[2])))
+    return planes
+
+def classify_aabb(planes, mn, mx):
+    """0 = outside the frustum, 1 = straddling, 2 = fully inside."""
+    result = 2
+    for nx, ny, nz, d in planes:
+        px, nx_ = (mx[0], mn[0]) if nx >= 0 else (mn[0], mx[0])
+        py, ny_ = (mx[1], mn[1]) if ny >= 0 else (mn[1], mx[1])
+        pz, nz_ = (mx[2], mn[2]) if nz >= 0 else (mn[2], mx[2])
+        if nx*px + ny*py + nz*pz + d < 0:
+            return 0
+        if nx*nx_ + ny*ny_ + nz*nz_ + d < 0:
+            result = 1
+    return result
+
+def cull_objects(mesh, planes):
+    """Indices of mesh objects whose AABB touches the frustum, rejecting whole BVH subtrees."""
+    visible = []
+    stack = [0] if mesh.bvh else []
+    nodes, bounds = mesh.bvh, mesh.bounds
+    while stack:
+        mn, mx, left, right, items = nodes[stack.pop()]
+        side = classify_aabb(planes, mn, mx)
+        if side == 0:
+            continue
+        if side == 2:
+            visible.extend(items)
+        elif left < 0:
+            visible.extend(i for i in items if classify_aabb(planes, *bounds[i]))
+        else:
+            stack.append(right)
+            stack.append(left)
+    return visible
+
+# --- Batched vertex stage (NumPy) ---
+def project_all(verts, cam_pos, cam_rot, scale=1.0):
+    """to_view() + project_view() for an (N, 3) array in one pass: screen x, screen y, depth and visibility mask."""
+    rel = verts - np.asarray(cam_pos, dtype=np.float32)
+    cy, sy = math.cos(cam_rot[1]), math.sin(cam_rot[1])
+    x = rel[:, 0] * cy + rel[:, 2] * sy
+    z = -rel[:, 0] * sy + rel[:, 2] * cy
+    cx, sx = math.cos(cam_rot[0]), math.sin(cam_rot[0])
+    y = rel[:, 1] * cx - z * sx
+    z = rel[:, 1] * sx + z * cx
+    visible = z > NEAR
+    f = (W * 0.5) / math.tan(math.radians(FOV * 0.5)) * scale / np.where(visible, z, 1.0)
+    return W * 0.5 * scale + x * f, H * 0.5 * scale - y * f, z, visible
+
+def collect_mesh(mesh, cam_pos, cam_rot, to_draw, planes=None, stats=None, scale=1.0, impostors=None):
+    """Cull objects, project each of their unique vertices once and queue front-facing,
+    in-front triangles as (depth, pts, fill, edge, zs). stats, if given, gets the
+    triangles submitted and queued added to its "submitted"/"drawn" counters; scale is
+    the render scale passed to project_view(). With an ImpostorCache, distant objects are
+    queued there as sprites instead, and their triangles counted as "impostored"."""
+    if planes is None:
+        planes = view_frustum(cam_pos, cam_rot)
+    queued = len(to_draw)
+    visible = cull_objects(mesh, planes)
+    near = visible if impostors is None else impostors.split(mesh, visible, cam_pos, cam_rot, scale)
+    _collect_mesh(mesh, near, cam_pos, cam_rot, to_draw, scale)
+    if stats is not None:
+        stats["submitted"] += len(mesh.tris)
+        stats["drawn"] += len(to_draw) - queued
+        if len(near) < len(visible):
+            kept = set(near)
+            stats["impostored"] = stats.get("impostored", 0) + sum(
+                mesh.objects[i][3] - mesh.objects[i][2] for i in visible if i not in kept)
+
+def _collect_mesh(mesh, visible, cam_pos, cam_rot, to_draw, scale):
+    objects = [mesh.objects[i] for i in visible]
+    if not objects:
+        return
+    fills, edges = mesh.fills, mesh.edges
+    if mesh.vectorised:
+        # Backfaces go first, so only vertices of front-facing triangles get projected.
+        tsel = None if len(objects) == len(mesh.objects) else np.concatenate(
+            [np.arange(t0, t1) for _, _, t0, t1 in objects])
+        normals = mesh.normals if tsel is None else mesh.normals[tsel]
+        plane_d = mesh.plane_d if tsel is None else mesh.plane_d[tsel]
+        front = np.flatnonzero(normals @ np.asarray(cam_pos, dtype=np.float32) > plane_d)
+        idx = front if tsel is None else tsel[front]
+        tris = mesh.tris[idx]
+        n = len(mesh.verts)
+        used = np.zeros(n, bool)
+        used[tris.ravel()] = True
+        vsel = np.flatnonzero(used)
+        sx, sy, z = np.zeros(n, np.float32), np.zeros(n, np.float32), np.zeros(n, np.float32)
+        visible = np.zeros(n, bool)
+        sx[vsel], sy[vsel], z[vsel], visible[vsel] = project_all(mesh.verts[vsel], cam_pos, cam_rot, scale)
+        vis = visible[tris]
+        whole = vis.all(axis=1)
+        for t in np.flatnonzero(vis.any(axis=1) & ~whole).tolist():
+            a, b, c = (to_view(v, cam_pos, cam_rot) for v in mesh.verts[tris[t]].tolist())
+            queue_clipped(to_draw, a, b, c, fills[idx[t]], edges[idx[t]], scale)
+        idx, tris = idx[whole], tris[whole]
+        pts = np.stack((sx, sy), axis=1)[tris].tolist()
+        zs = z[tris]
+        depth = zs.mean(axis=1).tolist()
+        for i, ps, d, tz in zip(idx.tolist(), pts, depth, zs.tolist()):
+            to_draw.append((d, ps, fills[i], edges[i], tz))
+        return
+    cx, cy, cz = cam_pos
+    for v0, v1, t0, t1 in objects:
+        # View-space and screen positions are filled in lazily, only for front-facing triangles.
+        view = [None] * (v1 - v0)
+        proj = [None] * (v1 - v0)
+        for t in range(t0, t1):
+            n = mesh.normals[t]
+            if n[0]*cx + n[1]*cy + n[2]*cz <= mesh.plane_d[t]:
+                continue
+            ids = [i - v0 for i in mesh.tris[t]]
+            for q in ids:
+                if view[q] is None:
+                    view[q] = to_view(mesh.verts[v0 + q], cam_pos, cam_rot)
+                    if view[q][2] > NEAR:
+                        proj[q] = project_view(view[q], scale)
+            a, b, c = proj[ids[0]], proj[ids[1]], proj[ids[2]]
+            if a is None or b is None or c is None:
+                queue_clipped(to_draw, view[ids[0]], view[ids[1]], view[ids[2]], fills[t], edges[t], scale)
+                continue
+            to_draw.append(((a[2] + b[2] + c[2]) / 3, [a[:2], b[:2], c[:2]], fills[t], edges[t],
+                            (a[2], b[2], c[2])))
+
+def sort_queued(to_draw):
+    # Stable and back to front, like key=-depth, but without a Python-level key call per triangle.
+    to_draw.sort(key=itemgetter(0), reverse=True)
+
+def draw_queued(surf, to_draw):
+    for _, ps, fill, edge, _ in to_draw:
+        if fill is None:  # ImpostorCache sprite: (depth, surface, None, topleft, None)
+            surf.blit(ps, edge)
+            continue
+        pygame.draw.polygon(surf, fill, ps)
+        pygame.draw.polygon(surf, edge, ps, 1)
+
+# --- Impostors (distant objects as cached sprites) ---
+class ImpostorCache:
+    """Distant mesh objects drawn as one sprite each instead of their triangles.
+
+    An object qualifies while its bounding sphere is at least IMPOSTOR_DISTANCE away and
+    small next to that distance. It is baked once per view direction, quantised to
+    IMPOSTOR_ANGLE steps of yaw and pitch, and per power-of-two pixel radius, so a sprite
+    re-bakes only when the view drifts onto a new step and is only ever scaled down when
+    drawn; the scaled copy is kept until the on-screen size changes. Sprites are colour-keyed
+    (cheaper to scale and blit than per-pixel alpha) and live in an LRU capped at
+    IMPOSTOR_CACHE bytes of pixels.
+
+    Each frame starts with begin(); split() then fills `queued` with (depth, surface,
+    None, topleft, None) entries that sort in with the painter's queue or are depth
+    tested by ZBuffer.blit_sprite().
+    """
+
+    def __init__(self, budget=IMPOSTOR_CACHE):
+        self.budget = budget
+        self.sprites = OrderedDict()
+        self.bytes = 0
+        self.baked = 0
+        self.queued = []
+        self.lock = threading.Lock()  # collect_mesh() may run on render threads
+
+    def begin(self):
+        self.queued = []
+
+    def split(self, mesh, objects, cam_pos, cam_rot, scale=1.0):
+        """Queue sprites for the far ones of `objects` (mesh object indices); returns the rest."""
+        near = []
+        f = (W * 0.5) / math.tan(math.radians(FOV * 0.5)) * scale
+        for i in objects:
+            mn, mx = mesh.bounds[i]
+            center = ((mn[0] + mx[0]) * 0.5, (mn[1] + mx[1]) * 0.5, (mn[2] + mx[2]) * 0.5)
+            radius = 0.5 * math.dist(mn, mx)
+            dist = math.dist(center, cam_pos)
+            p = to_view(center, cam_pos, cam_rot)
+            if dist - radius < IMPOSTOR_DISTANCE or radius > IMPOSTOR_MAX_SIZE * dist or p[2] <= NEAR:
+                near.append(i)
+                continue
+            pitch = round(math.asin(max(-1.0, min(1.0, (center[1] - cam_pos[1]) / dist))) / IMPOSTOR_ANGLE)
+            yaw = round(math.atan2(cam_pos[0] - center[0], center[2] - cam_pos[2]) / IMPOSTOR_ANGLE)
+            px = radius * f / p[2]
+            size = max(1, math.ceil(math.log2(max(px, 1.0))))
+            entry = self.get(mesh, i, yaw, pitch, size, center, radius)
+            # Baked with radius -> 2**size * IMPOSTOR_DISTANCE / D pixels at the sprite's centre depth D.
+            k = px * (IMPOSTOR_DISTANCE + radius) / ((1 << size) * IMPOSTOR_DISTANCE)
+            w = max(1, round(entry[0].get_width() * k))
+            if entry[1] != w:
+                entry[2] = pygame.transform.scale(entry[0], (w, w))
+                entry[1] = w
+            sprite = entry[2]
+            sx, sy = W * 0.5 * scale + p[0] * f / p[2], H * 0.5 * scale - p[1] * f / p[2]
+            with self.lock:
+                self.queued.append((p[2], sprite, None, (round(sx - w * 0.5), round(sy - w * 0.5)), None))
+        return near
+
+    def get(self, mesh, i, yaw, pitch, size, center, radius):
+        """[sprite, scaled width, scaled sprite] for one object and quantised view, baked on a miss."""
+        key = (mesh.uid, i, yaw, pitch, size)
+        with self.lock:
+            entry = self.sprites.get(key)
+            if entry is not None:
+                self.sprites.move_to_end(key)
+                return entry
+        sprite = self.bake(mesh, i, (pitch * IMPOSTOR_ANGLE, yaw * IMPOSTOR_ANGLE), 1 << size, center, radius)
+        with self.lock:
+            entry = self.sprites.get(key)
+            if entry is None:
+                entry = self.sprites[key] = [sprite, sprite.get_width(), sprite]
+                # The scaled copy is never larger than the bake, so count the bake twice.
+                self.bytes += 2 * sprite.get_width() * sprite.get_height() * sprite.get_bytesize()
+                self.baked += 1
+            while self.bytes > self.budget and len(self.sprites) > 1:
+                _, (old, _, _) = self.sprites.popitem(last=False)
+                self.bytes -= 2 * old.get_width() * old.get_height() * old.get_bytesize()
+        return entry
+
+    def bake(self, mesh, i, rot, r_px, center, radius):
+        """Draw one object, seen along rot from IMPOSTOR_DISTANCE beyond its bounding sphere,
+        into a transparent sprite whose centre is the object's centre."""
+        dist = IMPOSTOR_DISTANCE + radius
+        fwd = camera_axes(rot)[2]
+        eye = [center[a] - fwd[a] * dist for a in range(3)]
+        f = r_px * IMPOSTOR_DISTANCE / radius
+        size = 2 * r_px + 2
+        v0, v1, t0, t1 = mesh.objects[i]
+        verts, tris = mesh.verts[v0:v1], mesh.tris[t0:t1]
+        normals, plane_d = mesh.normals[t0:t1], mesh.plane_d[t0:t1]
+        if mesh.vectorised:
+            verts, tris, normals, plane_d = verts.tolist(), tris.tolist(), normals.tolist(), plane_d.tolist()
+        queued = []
+        for t, ids in enumerate(tris):
+            n = normals[t]
+            if n[0]*eye[0] + n[1]*eye[1] + n[2]*eye[2] <= plane_d[t]:
+                continue
+            view = [to_view(verts[j - v0], eye, rot) for j in ids]
+            ps = [(size * 0.5 + x * f / z, size * 0.5 - y * f / z) for x, y, z in view]
+            queued.append((sum(p[2] for p in view) / 3, ps, mesh.fills[t0 + t], mesh.edges[t0 + t]))
+        queued.sort(key=itemgetter(0), reverse=True)
+        surf = pygame.Surface((size, size))
+        surf.fill(IMPOSTOR_KEY)
+        surf.set_colorkey(IMPOSTOR_KEY, pygame.RLEACCEL)
+        for _, ps, fill, edge in queued:
+            pygame.draw.polygon(surf, fill, ps)
+            pygame.draw.polygon(surf, edge, ps, 1)
+        return surf
+
+# --- Instanced models ---
+class Instance:
+    """One placement of a shared model-space Mesh: position, yaw and uniform scale.
+
+    The mesh is compiled once; moving an instance only rebuilds its 3x3 matrix, and the
+    vertex stage applies it. Flat shading stays as baked in model space.
+    """
+
+    def __init__(self, mesh, pos=(0.0, 0.0, 0.0), yaw=0.0, scale=1.0):
+        self.mesh = mesh
+        mn = [min(b[0][a] for b in mesh.bounds) for a in range(3)]
+        mx = [max(b[1][a] for b in mesh.bounds) for a in range(3)]
+        self.center = [(lo + hi) * 0.5 for lo, hi in zip(mn, mx)]
+        self.half = [(hi - lo) * 0.5 for lo, hi in zip(mn, mx)]
+        self.pos = tuple(pos)
+        self.yaw = yaw
+        self.scale = scale
+        self.matrix = None
+        self.place(pos, yaw, scale)
+
+    def place(self, pos, yaw=None, scale=None):
+        if yaw is not None:
+            self.yaw = yaw
+        if scale is not None:
+            self.scale = scale
+        self.pos = (pos[0], pos[1], pos[2])
+        c, s = math.cos(self.yaw) * self.scale, math.sin(self.yaw) * self.scale
+        self.matrix = ((c, 0.0, s), (0.0, self.scale, 0.0), (-s, 0.0, c))
+
+    def to_world(self, v):
+        m, t = self.matrix, self.pos
+        return tuple(m[r][0] * v[0] + m[r][1] * v[1] + m[r][2] * v[2] + t[r] for r in range(3))
+
+    def to_model(self, p):
+        """World point into model space (the matrix is a rotation times a uniform scale)."""
+        m, t = self.matrix, self.pos
+        d = (p[0] - t[0], p[1] - t[1], p[2] - t[2])
+        k = 1.0 / (self.scale * self.scale)
+        return tuple((m[0][a] * d[0] + m[1][a] * d[1] + m[2][a] * d[2]) * k for a in range(3))
+
+    def bounds(self):
+        """World AABB of the model's AABB under the current transform."""
+        m = self.matrix
+        c = self.to_world(self.center)
+        e = [abs(m[r][0]) * self.half[0] + abs(m[r][1]) * self.half[1] + abs(m[r][2]) * self.half[2]
+             for r in range(3)]
+        return tuple(c[r] - e[r] for r in range(3)), tuple(c[r] + e[r] for r in range(3))
+
+def collect_instances(instances, cam_pos, cam_rot, to_draw, planes=None, stats=None, scale=1.0):
+    """collect_mesh() for instances: frustum-cull each by its world AABB, then transform,
+    project and queue the survivors, batched per shared mesh."""
+    if planes is None:
+        planes = view_frustum(cam_pos, cam_rot)
+    groups = {}
+    for inst in instances:
+        if stats is not None:
+            stats["submitted"] += len(inst.mesh.tris)
+        if classify_aabb(planes, *inst.bounds()):
+            groups.setdefault(id(inst.mesh), []).append(inst)
+    queued = len(to_draw)
+    for group in groups.values():
+        _collect_instances(group[0].mesh, group, cam_pos, cam_rot, to_draw, scale)
+    if stats is not None:
+        stats["drawn"] += len(to_draw) - queued
+
+def _collect_instances(mesh, insts, cam_pos, cam_rot, to_draw, scale):
+    fills, edges = mesh.fills, mesh.edges
+    if mesh.vectorised:
+        n = len(mesh.verts)
+        rot = np.array([inst.matrix for inst in insts], dtype=np.float32)
+        off = np.array([inst.pos for inst in insts], dtype=np.float32)
+        world = mesh.verts @ rot.transpose(0, 2, 1) + off[:, None, :]
+        world = world.reshape(-1, 3)
+        sx, sy, z, visible = project_all(world, cam_pos, cam_rot, scale)
+        k2 = np.array([inst.scale * inst.scale for inst in insts], dtype=np.float32)
+        local = np.einsum("kij,ki->kj", rot, np.asarray(cam_pos, dtype=np.float32) - off) / k2[:, None]
+        tris = mesh.tris[None] + (np.arange(len(insts), dtype=np.int32) * n)[:, None, None]
+        front = (local @ mesh.normals.T) > mesh.plane_d
+        vis = visible[tris]
+        whole = vis.all(axis=2)
+        for k, t in zip(*np.nonzero(front & vis.any(axis=2) & ~whole)):
+            a, b, c = (to_view(v, cam_pos, cam_rot) for v in world[tris[k, t]].tolist())
+            queue_clipped(to_draw, a, b, c, fills[t], edges[t], scale)
+        ki, ti = np.nonzero(front & whole)
+        tris = tris[ki, ti]
+        pts = np.stack((sx, sy), axis=1)[tris].tolist()
+        zs = z[tris]
+        depth = zs.mean(axis=1).tolist()
+        for i, ps, d, tz in zip(ti.tolist(), pts, depth, zs.tolist()):
+            to_draw.append((d, ps, fills[i], edges[i], tz))
+        return
+    for inst in insts:
+        cx, cy, cz = inst.to_model(cam_pos)
+        view = [to_view(inst.to_world(v), cam_pos, cam_rot) for v in mesh.verts]
+        proj = [project_view(p, scale) if p[2] > NEAR else None for p in view]
+        for t, (i, j, k) in enumerate(mesh.tris):
+            nx, ny, nz = mesh.normals[t]
+            if nx*cx + ny*cy + nz*cz <= mesh.plane_d[t]:
+                continue
+            a, b, c = proj[i], proj[j], proj[k]
+            if a is None or b is None or c is None:
+                queue_clipped(to_draw, view[i], view[j], view[k], fills[t], edges[t], scale)
+                continue
+            to_draw.append(((a[2] + b[2] + c[2]) / 3, [a[:2], b[:2], c[:2]], fills[t], edges[t], (a[2], b[2], c[2])))
+
+# --- Z-buffer raster backend (NumPy) ---
+class ZBuffer:
+    """Software rasteriser filling queued triangles into NumPy colour and depth buffers.
+
+    Depth is stored as 1/z, which interpolates linearly in screen space, so intersecting
+    geometry resolves per pixel instead of per triangle. Buffers are indexed [x, y] to
+    match pygame.surfarray, and the frame reaches the screen in a single blit_array().
+    """
+
+    def __init__(self):
+        self.size = None
+        self.color = None
+        self.depth = None
+        self.shared = None  # (colour, depth) SharedMemory blocks while rendering for a process pool
+        self.stats = {"tris": 0, "tested": 0, "written": 0}
+
+    def begin(self, surf, shared=False):
+        """Start a frame on surf's pixels; shared puts both buffers in shared memory, so
+        RenderPool worker processes can rasterise into them."""
+        size = surf.get_size()
+        if size != self.size or shared != (self.shared is not None):
+            self.close()
+            self.size = size
+            if shared:
+                self.shared = (shared_memory.SharedMemory(create=True, size=max(1, size[0] * size[1] * 3)),
+                               shared_memory.SharedMemory(create=True, size=max(1, size[0] * size[1] * 4)))
+                self.color = np.ndarray((size[0], size[1], 3), np.uint8, self.shared[0].buf)
+                self.depth = np.ndarray(size, np.float32, self.shared[1].buf)
+            else:
+                self.color = np.empty((size[0], size[1], 3), dtype=np.uint8)
+                self.depth = np.empty(size, dtype=np.float32)
+        self.color[...] = pygame.surfarray.pixels3d(surf)
+        self.depth.fill(0.0)
+        self.stats = {"tris": 0, "tested": 0, "written": 0}
+
+    def fill_tri(self, ps, zs, fill, edge, rows=None, stats=None):
+        """Rasterise one triangle, or a convex polygon from queue_clipped(), optionally only
+        inside the screen rows [rows[0], rows[1])."""
+        if len(ps) == 3:
+            fan = 1
+        else:
+            # Depth comes from the polygon's plane; take it from its widest fan triangle.
+            fan = max(range(1, len(ps) - 1), key=lambda i: abs(
+                (ps[i][0] - ps[0][0]) * (ps[i + 1][1] - ps[0][1])
+                - (ps[i][1] - ps[0][1]) * (ps[i + 1][0] - ps[0][0])))
+        (x0, y0), (x1, y1), (x2, y2) = ps[0], ps[fan], ps[fan + 1]
+        z0, z1, z2 = zs[0], zs[fan], zs[fan + 1]
+        area = (x1 - x0) * (y2 - y0) - (y1 - y0) * (x2 - x0)
+        if abs(area) < 1e-6:
+            return
+        w, h = self.size
+        lo, hi = rows if rows is not None else (0, h)
+        xs, ys = [p[0] for p in ps], [p[1] for p in ps]
+        bx0, bx1 = max(0, int(min(xs))), min(w, int(max(xs)) + 1)
+        by0, by1 = max(lo, int(min(ys))), min(hi, int(max(ys)) + 1)
+        if stats is None:
+            stats = self.stats
+            stats["tris"] += 1
+        if bx0 >= bx1 or by0 >= by1:
+            return
+        px = np.arange(bx0, bx1, dtype=np.float32)[:, None] + 0.5
+        py = np.arange(by0, by1, dtype=np.float32)[None, :] + 0.5
+        inv = 1.0 / area
+        e0 = ((x2 - x1) * (py - y1) - (y2 - y1) * (px - x1)) * inv
+        e1 = ((x0 - x2) * (py - y2) - (y0 - y2) * (px - x2)) * inv
+        e2 = 1.0 - e0 - e1
+        a2 = abs(area)
+        if len(ps) == 3:
+            inside = (e0 >= 0) & (e1 >= 0) & (e2 >= 0)
+        else:
+            # Distance to each polygon edge, in pixels; the polygon winds like its fan triangles.
+            # Edges at least a pixel clear of every corner of the box (guard band edges, mostly)
+            # can neither cut nor outline it, and are skipped.
+            sides = []
+            for (sx, sy), (qx, qy) in zip(ps, ps[1:] + ps[:1]):
+                inv_len = a2 * inv / max(1e-6, math.hypot(qx - sx, qy - sy))
+                if min(((qx - sx) * (by - sy) - (qy - sy) * (bx - sx)) * inv_len
+                       for bx in (bx0, bx1) for by in (by0, by1)) < 1.0:
+                    sides.append(((qx - sx) * (py - sy) - (qy - sy) * (px - sx)) * inv_len)
+            if not sides:
+                sides.append(np.full((bx1 - bx0, by1 - by0), np.inf, dtype=np.float32))
+            inside = sides[0] >= 0
+            for d in sides[1:]:
+                inside &= d >= 0
+        tested = int(inside.sum())
+        if not tested:
+            return
+        iz = e0 * (1.0 / z0) + e1 * (1.0 / z1) + e2 * (1.0 / z2)
+        depth = self.depth[bx0:bx1, by0:by1]
+        mask = inside & (iz > depth)
+        written = int(mask.sum())
+        stats["tested"] += tested
+        stats["written"] += written
+        if not written:
+            return
+        depth[mask] = iz[mask]
+        # One-pixel outline like the polygon path: distance to the nearest edge, in pixels.
+        if len(ps) == 3:
+            dist = np.minimum(np.minimum(e0 * (a2 / max(1e-6, math.hypot(x2 - x1, y2 - y1))),
+                                         e1 * (a2 / max(1e-6, math.hypot(x0 - x2, y0 - y2)))),
+                              e2 * (a2 / max(1e-6, math.hypot(x1 - x0, y1 - y0))))
+        else:
+            dist = sides[0]
+            for d in sides[1:]:
+                dist = np.minimum(dist, d)
+        color = self.color[bx0:bx1, by0:by1]
+        color[mask & (dist >= 1.0)] = fill
+        color[mask & (dist < 1.0)] = edge
+
+    def blit_sprite(self, sprite, topleft, z):
+        """Depth-test an impostor sprite's non-colour-key pixels as a flat card at view depth z."""
+        w, h = self.size
+        x0, y0 = topleft
+        bx0, bx1 = max(0, x0), min(w, x0 + sprite.get_width())
+        by0, by1 = max(0, y0), min(h, y0 + sprite.get_height())
+        self.stats["tris"] += 1
+        if bx0 >= bx1 or by0 >= by1:
+            return
+        inside = pygame.surfarray.array_colorkey(sprite)[bx0 - x0:bx1 - x0, by0 - y0:by1 - y0] > 0
+        depth = self.depth[bx0:bx1, by0:by1]
+        mask = inside & (1.0 / z > depth)
+        self.stats["tested"] += int(inside.sum())
+        self.stats["written"] += int(mask.sum())
+        depth[mask] = 1.0 / z
+        self.color[bx0:bx1, by0:by1][mask] = pygame.surfarray.array3d(sprite)[bx0 - x0:bx1 - x0, by0 - y0:by1 - y0][mask]
+
+    def end(self, surf):
+        pygame.surfarray.blit_array(surf, self.color)
+
+    def close(self):
+        """Free the buffers, unlinking shared memory blocks."""
+        self.size = self.color = self.depth = None
+        if self.shared is not None:
+            for block in self.shared:
+                block.close()
+                block.unlink()
+            self.shared = None
+
+    def stats_text(self):
+        st = self.stats
+        fill = st["written"] / max(1, self.size[0] * self.size[1])
+        return "zbuffer: %d tris  %d px tested  %d px written  %.2fx screen" % (
+            st["tris"], st["tested"], st["written"], fill)
+
+def bin_rows(to_draw, h, bands):
+    """Split queued triangles into `bands` row bands of an h-pixel-high target, in one pass:
+    each (pts, zs, fill, edge) goes to every band its pixel rows touch. Returns the
+    bands' row ranges and triangle lists."""
+    step = -(-h // bands)
+    bins = [[] for _ in range(bands)]
+    for _, ps, fill, edge, zs in to_draw:
+        ys = [p[1] for p in ps]
+        tri = (ps, zs, fill, edge)
+        for b in range(max(0, int(min(ys)) // step), min(bands - 1, int(max(ys)) // step) + 1):
+            bins[b].append(tri)
+    return [(y, min(h, y + step)) for y in range(0, bands * step, step)], bins
+
+def _raster_rows(zbuf, tris, rows):
+    stats = {"tested": 0, "written": 0}
+    for ps, zs, fill, edge in tris:
+        zbuf.fill_tri(ps, zs, fill, edge, rows, stats)
+    return stats
+
+_raster_target = None  # (block names, ZBuffer over them, blocks) in a RenderPool worker process
+
+def _pool_raster_rows(names, size, tris, rows):
+    """_raster_rows() in a worker process, into the caller's shared-memory buffers."""
+    global _raster_target
+    if _raster_target is None or _raster_target[0] != names:
+        if _raster_target is not None:
+            _raster_target[1].color = _raster_target[1].depth = None
+            for block in _raster_target[2]:
+                block.close()
+        blocks = [shared_memory.SharedMemory(name=n) for n in names]
+        target = ZBuffer()
+        target.size = size
+        target.color = np.ndarray((size[0], size[1], 3), np.uint8, blocks[0].buf)
+        target.depth = np.ndarray(size, np.float32, blocks[1].buf)
+        _raster_target = (names, target, blocks)
+    return _raster_rows(_raster_target[1], tris, rows)
+
+def raster_queued(zbuf, surf, to_draw, pool=None, sprites=()):
+    """Fill queued triangles through the z-buffer. With a RenderPool the screen is split into
+    one row band per worker; triangles are binned into bands once, and bands rasterise
+    concurrently, each into its own slice of both buffers. Impostor sprites are depth tested
+    afterwards on the calling thread."""
+    zbuf.begin(surf, pool is not None and not pool.threaded)
+    if pool is None:
+        for _, ps, fill, edge, zs in to_draw:
+            zbuf.fill_tri(ps, zs, fill, edge)
+    else:
+        bands, bins = bin_rows(to_draw, zbuf.size[1], pool.workers)
+        zbuf.stats["tris"] = len(to_draw)
+        if pool.threaded:
+            results = pool.map(lambda b: _raster_rows(zbuf, bins[b], bands[b]), range(len(bands)))
+        else:
+            names = tuple(block.name for block in zbuf.shared)
+            results = pool.executor.map(_pool_raster_rows, [names] * len(bands), [zbuf.size] * len(bands),
+                                        bins, bands)
+        for st in results:
+            zbuf.stats["tested"] += st["tested"]
+            zbuf.stats["written"] += st["written"]
+    for z, sprite, _, topleft, _ in sprites:
+        zbuf.blit_sprite(sprite, topleft, z)
+    zbuf.end(surf)
+
+def gil_enabled():
+    """False on free-threaded (PEP 703) builds, where render threads run Python code in parallel."""
+    return getattr(sys, "_is_gil_enabled", lambda: True)()
+
+class RenderPool:
+    """Render workers. Without a GIL (free-threaded builds) they are threads, and both
+    per-mesh transforms and z-buffer bands run on them. With the GIL, threads would
+    serialise on the per-triangle Python code, so they are processes that only rasterise
+    z-buffer bands, into shared-memory buffers (ZBuffer.begin(shared=True))."""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.threaded = not gil_enabled()
+        if self.threaded:
+            self.executor = ThreadPoolExecutor(workers, thread_name_prefix="render")
+        else:
+            self.executor = ProcessPoolExecutor(workers)
+
+    def map(self, fn, items):
+        return self.executor.map(fn, items)
+
+    def shutdown(self):
+        self.executor.shutdown()
 
 def box_tris(cx, cy, cz, w, h, d):
     hw, hh, hd = w/2, h/2, d/2
@@ -80,14 +860,15 @@ def box_tris(cx, cy, cz, w, h, d):
         (verts[21], verts[20], verts[23]), (verts[21], verts[23], verts[22]),
     ]
 
-def get_castle_scene():
+def get_castle_scene(ground=True):
+    """Castle props; ground=False leaves out the flat ground slabs (for use with Terrain)."""
     green = (34, 139, 34)
     brown = (139, 90, 43)
     brick = (178, 34, 34)
     gold = (218, 165, 32)
     scene = []
     gw = 40
-    for dx in range(-1, 2):
+    for dx in range(-1, 2) if ground else ():
         for dz in range(-1, 2):
             scene.append((box_tris(dx*gw*2, -1, dz*gw*2, gw, 1, gw), green))
     for cx, cy, cz, w, h, d, col in [
@@ -102,34 +883,127 @@ def get_castle_scene():
         scene.append((box_tris(-15, i*2, 15, s, 2, s), green))
     return scene
 
-def get_mario_tris(pos):
-    x, y, z = pos[0], pos[1], pos[2]
+def replicate_scene(scene, copies, spacing=240.0):
+    """Tile `copies` translated copies of a scene on a square grid (copy 0 stays in place)."""
+    side = max(1, math.ceil(math.sqrt(copies)))
+    out = []
+    for n in range(copies):
+        ox, oz = (n % side) * spacing, (n // side) * spacing
+        for tri_list, color in scene:
+            out.append(([tuple((p[0] + ox, p[1], p[2] + oz) for p in tri) for tri in tri_list], color))
+    return out
+
+def get_mario_model():
+    """Mario in model space, origin at the body centre (target_pos)."""
     mario_red = (220, 40, 60)
     mario_skin = (255, 213, 170)
-    body = (box_tris(x, y, z, 0.5, 0.75, 0.35), mario_red)
-    head = (box_tris(x, y + 1.0, z, 0.35, 0.3, 0.35), mario_skin)
+    body = (box_tris(0, 0, 0, 0.5, 0.75, 0.35), mario_red)
+    head = (box_tris(0, 1.0, 0, 0.35, 0.3, 0.35), mario_skin)
     return [body, head]
 
+def get_coin_model():
+    coin_yellow = (255, 210, 40)
+    return [(box_tris(0, 0, 0, 0.6, 0.6, 0.12), coin_yellow)]
+
+# --- Cached backgrounds ---
+_backgrounds = {}
+
+def gradient_background(size, top, bottom):
+    """Vertical gradient Surface for (size, palette), rendered once and reused every frame."""
+    key = (size, top, bottom)
+    surf = _backgrounds.get(key)
+    if surf is None:
+        w, h = size
+        surf = pygame.Surface(size)
+        for y in range(h + 1):
+            t = y / max(1, h)
+            pygame.draw.line(surf, tuple(max(0, min(255, int(a + (b - a) * t))) for a, b in zip(top, bottom)),
+                             (0, y), (w, y))
+        _backgrounds[key] = surf
+    return surf
+
+def clear_backgrounds():
+    _backgrounds.clear()
+
 def draw_sky(screen):
-    for y in range(H + 1):
-        t = y / max(1, H)
-        r = int(135 + (60 - 135) * t)
-        g = int(206 + (120 - 206) * t)
-        b = int(250 + (200 - 250) * t)
-        pygame.draw.line(screen, (max(0, min(255, r)), max(0, min(255, g)), max(0, min(255, b))), (0, y), (W, y))
-
-def draw_hud(screen):
-    font = pygame.font.Font(None, 28)
-    t = font.render("WASD move Mario | Mouse orbit | SPACE jump | ESC quit", True, (220, 220, 220))
-    screen.blit(t, (10, H - 30))
+    screen.blit(gradient_background(screen.get_size(), (135, 206, 250), (60, 120, 200)), (0, 0))
+
+# --- Offscreen 3D targets ---
+_views = {}
+
+def view_surface(screen, scale):
+    """Surface the 3D pass renders into at `scale` of the window: the screen itself at full
+    scale, otherwise a cached offscreen surface that is scaled up afterwards."""
+    if scale >= 1.0:
+        return screen
+    size = (max(1, int(W * scale)), max(1, int(H * scale)))
+    surf = _views.get(size)
+    if surf is None:
+        surf = _views[size] = pygame.Surface(size, 0, screen)
+    return surf
+
+def clear_views():
+    """Drop the offscreen targets, e.g. when a resize makes their sizes stale."""
+    _views.clear()
+
+# --- Text cache ---
+TEXT_CACHE_SIZE = 256
+TITLE_OUTLINE = ((180, 30, 30), ((-2, -2), (2, -2), (-2, 2), (2, 2), (-2, 0), (2, 0), (0, -2), (0, 2)))
+_fonts = {}
+_texts = OrderedDict()
+
+def get_font(size):
+    font = _fonts.get(size)
+    if font is None:
+        font = _fonts[size] = pygame.font.Font(None, size)
+    return font
+
+def render_text(text, size, color, outline=None):
+    """Rendered text Surface, LRU-cached by (text, size, colour, outline).
+
+    outline is (colour, offsets): the text is stamped at each offset in that colour and the
+    fill drawn on top, baked into one Surface so an outlined title is a single blit.
+    """
+    key = (text, size, color, outline)
+    surf = _texts.get(key)
+    if surf is not None:
+        _texts.move_to_end(key)
+        return surf
+    font = get_font(size)
+    surf = font.render(text, True, color)
+    if outline is not None:
+        edge_color, offsets = outline
+        edge = font.render(text, True, edge_color)
+        pad = max(max(abs(dx), abs(dy)) for dx, dy in offsets)
+        base = surf
+        surf = pygame.Surface((base.get_width() + 2 * pad, base.get_height() + 2 * pad), pygame.SRCALPHA)
+        for dx, dy in offsets:
+            surf.blit(edge, (pad + dx, pad + dy))
+        surf.blit(base, (pad, pad))
+    _texts[key] = surf
+    if len(_texts) > TEXT_CACHE_SIZE:
+        _texts.popitem(last=False)
+    return surf
+
+def shutdown():
+    """pygame.quit() for every exit path. The cached fonts and text go first: a Font that
+    outlives pygame.quit() crashes the next time it renders, even after pygame.init()."""
+    _fonts.clear()
+    _texts.clear()
+    pygame.quit()
+
+def blit_text(screen, text, size, color, center, outline=None):
+    surf = render_text(text, size, color, outline)
+    screen.blit(surf, surf.get_rect(center=center))
+
+def draw_hud(screen, info=None):
+    screen.blit(render_text("WASD move Mario | Mouse orbit | SPACE jump | F2 raster | F3/F4 profile | F5 res | ESC quit", 28, (220, 220, 220)),
+                (10, H - 30))
+    if info:
+        screen.blit(render_text(info, 28, (220, 220, 220)), (10, 10))
 
 def draw_menu(screen):
-    for y in range(H + 1):
-        t = y / max(1, H)
-        r = int(135 + (40 - 135) * t)
-        g = int(206 + (100 - 206) * t)
-        b = int(235 + (180 - 235) * t)
-        pygame.draw.line(screen, (max(0, r), max(0, g), max(0, b)), (0, y), (W, y))
+    screen.blit(gradient_background((W, H), (135, 206, 235), (40, 100, 180)), (0, 0))
     cx, cy = W // 2, H // 2 - 40
     star_pts = []
     for i in range(10):
@@ -138,196 +1012,1667 @@ def draw_menu(screen):
         star_pts.append((cx + rad * math.cos(ang), cy - rad * math.sin(ang)))
     pygame.draw.polygon(screen, (255, 215, 0), star_pts)
     pygame.draw.polygon(screen, (220, 180, 0), star_pts, 2)
-    title_text = "Cat's ! SM64"
     font_size = max(48, min(72, W // 14))
-    font = pygame.font.Font(None, font_size)
-    for dx, dy in [(-2, -2), (2, -2), (-2, 2), (2, 2), (-2, 0), (2, 0), (0, -2), (0, 2)]:
-        s = font.render(title_text, True, (180, 30, 30))
-        r = s.get_rect(center=(W // 2 + dx, H // 2 - 30 + dy))
-        screen.blit(s, r)
-    s = font.render(title_text, True, (255, 220, 0))
-    r = s.get_rect(center=(W // 2, H // 2 - 30))
-    screen.blit(s, r)
-    font_start = pygame.font.Font(None, 36)
-    start_surf = font_start.render("PRESS SPACE TO GO TO GAME", True, (255, 255, 255))
-    r_start = start_surf.get_rect(center=(W // 2, H - 100))
-    screen.blit(start_surf, r_start)
-    font_c = pygame.font.Font(None, 24)
-    c_surf = font_c.render("[C] Samsoft 1999-2026  [C] Nintendo 1999-2026", True, (200, 200, 200))
-    r_c = c_surf.get_rect(center=(W // 2, H - 40))
-    screen.blit(c_surf, r_c)
+    blit_text(screen, "Cat's ! SM64", font_size, (255, 220, 0), (W // 2, H // 2 - 30), TITLE_OUTLINE)
+    blit_text(screen, "PRESS SPACE TO GO TO GAME", 36, (255, 255, 255), (W // 2, H - 100))
+    blit_text(screen, "[C] Samsoft 1999-2026  [C] Nintendo 1999-2026", 24, (200, 200, 200), (W // 2, H - 40))
 
-def draw_file_select(screen, selected_index, file_stars):
-    for y in range(H + 1):
-        t = y / max(1, H)
-        r = int(60 + (30 - 60) * t)
-        g = int(100 + (60 - 100) * t)
-        b = int(180 + (120 - 180) * t)
-        pygame.draw.line(screen, (max(0, r), max(0, g), max(0, b)), (0, y), (W, y))
-    font_title = pygame.font.Font(None, 56)
-    title = font_title.render("FILE SELECT", True, (255, 255, 255))
-    r_title = title.get_rect(center=(W // 2, 80))
-    screen.blit(title, r_title)
+def file_slot_rect(i):
     slot_w, slot_h = 200, 140
     slot_y = H // 2 - slot_h // 2 - 20
     slots_x = [W // 2 - slot_w - 130, W // 2 - slot_w // 2 - 50, W // 2 + 130]
-    font_slot = pygame.font.Font(None, 36)
-    font_stars = pygame.font.Font(None, 28)
+    return pygame.Rect(slots_x[i], slot_y, slot_w, slot_h)
+
+def draw_file_slot(screen, i, selected_index, file_stars):
+    """Paint one file slot (it covers its whole rect) and return the rect for display.update().
+    file_stars[i] is the slot's star count, or None for an empty slot."""
+    rect = file_slot_rect(i)
+    sx, slot_y, slot_w, slot_h = rect
+    border = (255, 220, 100) if i == selected_index else (180, 180, 180)
+    pygame.draw.rect(screen, (40, 50, 90), rect)
+    pygame.draw.rect(screen, border, rect, 4)
+    blit_text(screen, "FILE " + str(i + 1), 36, (255, 255, 255), (sx + slot_w // 2, slot_y + 40))
+    stars_text = "STARS  " + str(file_stars[i]) + " / 120" if file_stars[i] is not None else "NEW GAME"
+    stars_color = (255, 220, 0) if file_stars[i] is not None else (160, 160, 160)
+    blit_text(screen, stars_text, 28, stars_color, (sx + slot_w // 2, slot_y + 90))
+    if i == selected_index:
+        cx, cy = sx + slot_w // 2, slot_y + 120
+        pts = []
+        for j in range(10):
+            rad = 14 if j % 2 == 0 else 6
+            ang = math.pi / 2 + (j * math.pi / 5)
+            pts.append((cx + rad * math.cos(ang), cy - rad * math.sin(ang)))
+        pygame.draw.polygon(screen, (255, 215, 0), pts)
+        pygame.draw.polygon(screen, (220, 180, 0), pts, 2)
+    return rect
+
+def draw_file_select(screen, selected_index, file_stars):
+    screen.blit(gradient_background((W, H), (60, 100, 180), (30, 60, 120)), (0, 0))
+    blit_text(screen, "FILE SELECT", 56, (255, 255, 255), (W // 2, 80))
     for i in range(3):
-        sx = slots_x[i]
-        border = (255, 220, 100) if i == selected_index else (180, 180, 180)
-        pygame.draw.rect(screen, (40, 50, 90), (sx, slot_y, slot_w, slot_h))
-        pygame.draw.rect(screen, border, (sx, slot_y, slot_w, slot_h), 4)
-        label = font_slot.render("FILE " + str(i + 1), True, (255, 255, 255))
-        r_label = label.get_rect(center=(sx + slot_w // 2, slot_y + 40))
-        screen.blit(label, r_label)
-        stars_text = "STARS  " + str(file_stars[i]) + " / 120" if file_stars[i] > 0 else "NEW GAME"
-        stars_color = (255, 220, 0) if file_stars[i] > 0 else (160, 160, 160)
-        stars_surf = font_stars.render(stars_text, True, stars_color)
-        r_star = stars_surf.get_rect(center=(sx + slot_w // 2, slot_y + 90))
-        screen.blit(stars_surf, r_star)
-        if i == selected_index:
-            cx, cy = sx + slot_w // 2, slot_y + 120
-            pts = []
-            for j in range(10):
-                rad = 14 if j % 2 == 0 else 6
-                ang = math.pi / 2 + (j * math.pi / 5)
-                pts.append((cx + rad * math.cos(ang), cy - rad * math.sin(ang)))
-            pygame.draw.polygon(screen, (255, 215, 0), pts)
-            pygame.draw.polygon(screen, (220, 180, 0), pts, 2)
-    font_inst = pygame.font.Font(None, 26)
-    inst = font_inst.render("LEFT/RIGHT or A/D: select file   SPACE or ENTER: start game", True, (200, 200, 200))
-    r_inst = inst.get_rect(center=(W // 2, H - 50))
-    screen.blit(inst, r_inst)
-    font_c = pygame.font.Font(None, 22)
-    c_surf = font_c.render("[C] Samsoft 1999-2026  [C] Nintendo 1999-2026", True, (150, 150, 150))
-    r_c = c_surf.get_rect(center=(W // 2, H - 22))
-    screen.blit(c_surf, r_c)
-
-def run():
+        draw_file_slot(screen, i, selected_index, file_stars)
+    blit_text(screen, "LEFT/RIGHT or A/D: select file   SPACE or ENTER: start game", 26, (200, 200, 200),
+              (W // 2, H - 50))
+    blit_text(screen, "[C] Samsoft 1999-2026  [C] Nintendo 1999-2026", 22, (150, 150, 150), (W // 2, H - 22))
+
+# --- Collision (SM64-style surfaces, spatially hashed) ---
+FLOOR, CEIL, WALL = 0, 1, 2
+
+class SurfaceGrid:
+    """Level triangles classified into floors, ceilings and walls and bucketed into a uniform
+    XZ grid, like SM64's surface partitions. Queries only look at the cells under Mario."""
+
+    def __init__(self, scene, cell=COLLISION_CELL):
+        self.cell = cell
+        self.surfaces = []
+        self.cells = {}
+        for tri_list, _ in scene:
+            pts = [p for tri in tri_list for p in tri]
+            if not pts:
+                continue
+            center = tuple(sum(p[a] for p in pts) / len(pts) for a in range(3))
+            for tri in tri_list:
+                self.add(tri, center)
+
+    def add(self, tri, center=None):
+        nx, ny, nz = face_normal(*tri)
+        mag = math.sqrt(nx*nx + ny*ny + nz*nz)
+        if mag < 1e-9:
+            return
+        nx, ny, nz = nx / mag, ny / mag, nz / mag
+        a = tri[0]
+        # box_tris() winds its +/-z faces inward, so point normals away from the entry's centre.
+        if center is not None and nx*(a[0]-center[0]) + ny*(a[1]-center[1]) + nz*(a[2]-center[2]) < 0:
+            nx, ny, nz = -nx, -ny, -nz
+        kind = FLOOR if ny > 0.01 else CEIL if ny < -0.01 else WALL
+        d = -(nx*a[0] + ny*a[1] + nz*a[2])
+        ys = [p[1] for p in tri]
+        idx = len(self.surfaces)
+        self.surfaces.append((kind, tri, (nx, ny, nz), d, min(ys), max(ys)))
+        for key in self._keys(min(p[0] for p in tri), min(p[2] for p in tri),
+                              max(p[0] for p in tri), max(p[2] for p in tri)):
+            bucket = self.cells.get(key)
+            if bucket is None:
+                bucket = self.cells[key] = ([], [], [])
+            bucket[kind].append(idx)
+
+    def _keys(self, x0, z0, x1, z1):
+        c = self.cell
+        for ix in range(math.floor(x0 / c), math.floor(x1 / c) + 1):
+            for iz in range(math.floor(z0 / c), math.floor(z1 / c) + 1):
+                yield ix, iz
+
+    def query(self, kind, x, z, r=0.0):
+        if r <= 0.0:
+            bucket = self.cells.get((math.floor(x / self.cell), math.floor(z / self.cell)))
+            return bucket[kind] if bucket else ()
+        found = set()
+        for key in self._keys(x - r, z - r, x + r, z + r):
+            bucket = self.cells.get(key)
+            if bucket:
+                found.update(bucket[kind])
+        return found
+
+    def _height_at(self, idx, x, z):
+        """Plane height of a floor/ceiling at (x, z), or None if (x, z) is outside it in XZ."""
+        _, (a, b, c), (nx, ny, nz), d, _, _ = self.surfaces[idx]
+        e0 = (b[0] - a[0]) * (z - a[2]) - (b[2] - a[2]) * (x - a[0])
+        e1 = (c[0] - b[0]) * (z - b[2]) - (c[2] - b[2]) * (x - b[0])
+        e2 = (a[0] - c[0]) * (z - c[2]) - (a[2] - c[2]) * (x - c[0])
+        if not ((e0 >= -1e-6 and e1 >= -1e-6 and e2 >= -1e-6) or (e0 <= 1e-6 and e1 <= 1e-6 and e2 <= 1e-6)):
+            return None
+        return -(nx*x + nz*z + d) / ny
+
+    def find_floor(self, x, y, z):
+        """Highest floor at or below y under (x, z), or None."""
+        best = None
+        for idx in self.query(FLOOR, x, z):
+            h = self._height_at(idx, x, z)
+            if h is not None and h <= y and (best is None or h > best):
+                best = h
+        return best
+
+    def find_ceil(self, x, y, z):
+        """Lowest ceiling at or above y over (x, z), or None."""
+        best = None
+        for idx in self.query(CEIL, x, z):
+            h = self._height_at(idx, x, z)
+            if h is not None and h >= y and (best is None or h < best):
+                best = h
+        return best
+
+    def resolve_walls(self, pos, radius, y0, y1):
+        """Push pos out of every wall within radius whose span overlaps heights [y0, y1]."""
+        for idx in self.query(WALL, pos[0], pos[2], radius):
+            _, (a, b, c), (nx, ny, nz), d, ymin, ymax = self.surfaces[idx]
+            if ymax <= y0 or ymin >= y1:
+                continue
+            offset = nx*pos[0] + ny*pos[1] + nz*pos[2] + d
+            if offset < -radius or offset > radius:
+                continue
+            # Inside test in the wall's own plane, projected along its dominant horizontal axis.
+            u = 2 if abs(nx) > abs(nz) else 0
+            y = min(max(pos[1], ymin), ymax)
+            pu = pos[u] - (nx, ny, nz)[u] * offset
+            e0 = (b[u] - a[u]) * (y - a[1]) - (b[1] - a[1]) * (pu - a[u])
+            e1 = (c[u] - b[u]) * (y - b[1]) - (c[1] - b[1]) * (pu - b[u])
+            e2 = (a[u] - c[u]) * (y - c[1]) - (a[1] - c[1]) * (pu - c[u])
+            if not ((e0 >= 0 and e1 >= 0 and e2 >= 0) or (e0 <= 0 and e1 <= 0 and e2 <= 0)):
+                continue
+            pos[0] += nx * (radius - offset)
+            pos[2] += nz * (radius - offset)
+
+class CombinedWorld:
+    """Collision against several worlds at once (e.g. a SurfaceGrid and a Terrain): the
+    highest floor, the lowest ceiling and every wall."""
+
+    def __init__(self, worlds):
+        self.worlds = [w for w in worlds if w is not None]
+
+    def find_floor(self, x, y, z):
+        floors = [h for h in (w.find_floor(x, y, z) for w in self.worlds) if h is not None]
+        return max(floors) if floors else None
+
+    def find_ceil(self, x, y, z):
+        ceils = [h for h in (w.find_ceil(x, y, z) for w in self.worlds) if h is not None]
+        return min(ceils) if ceils else None
+
+    def resolve_walls(self, pos, radius, y0, y1):
+        for w in self.worlds:
+            w.resolve_walls(pos, radius, y0, y1)
+
+# --- Heightmap terrain (chunked quadtree LOD) ---
+def make_heightmap(cells=TERRAIN_CELLS, spacing=TERRAIN_SPACING, flat=40.0):
+    """(cells + 1)^2 heights of rolling hills from a few sine octaves, eased down to the
+    old ground slab top (y = -0.5) within `flat` units of the castle."""
+    half = cells // 2
+    rows = []
+    for gz in range(cells + 1):
+        z = (gz - half) * spacing
+        row = []
+        for gx in range(cells + 1):
+            x = (gx - half) * spacing
+            h = (6.0 * math.sin(x * 0.021 + 1.3) * math.cos(z * 0.017 - 0.4)
+                 + 3.0 * math.sin(x * 0.053 - z * 0.041)
+                 + 1.2 * math.sin(x * 0.13 + 0.7) * math.sin(z * 0.11 + 2.1) + 4.0)
+            t = min(1.0, max(0.0, (math.hypot(x, z) - flat) / flat))
+            row.append(-0.5 + t * t * (3.0 - 2.0 * t) * h)
+        rows.append(row)
+    return rows
+
+class Terrain:
+    """Heightmap terrain drawn as a chunked quadtree.
+
+    Every chunk is a TERRAIN_LEAF x TERRAIN_LEAF grid whatever its size, and a chunk splits
+    into four while the camera is within TERRAIN_LOD chunk widths of it. Near ground gets
+    fine chunks and distant ground coarse ones, so the triangle count stays roughly flat as
+    the heightmap grows. Where a chunk borders a coarser one, its edge vertices are pulled
+    onto the coarser chunk's edge so the two meet without cracks. The chunks picked are
+    merged into one Mesh, kept until the camera moves far enough to change the pick. Floor
+    queries read the full-resolution heightmap.
+    """
+
+    def __init__(self, heights=None, spacing=TERRAIN_SPACING, leaf=TERRAIN_LEAF, lod=TERRAIN_LOD):
+        self.heights = heights if heights is not None else make_heightmap(spacing=spacing)
+        self.cells = len(self.heights) - 1
+        self.spacing = spacing
+        self.leaf = leaf
+        self.lod = lod
+        self.max_level = max(0, int(math.log2(self.cells // leaf)))
+        self.ranges = {}
+        self.cache = OrderedDict()
+        self.slack = 0.0  # how far the camera can move before a split decision of the last selection flips
+        self.selected = None  # (camera position, Mesh) of the last chunk selection
+        self.grid = None  # NumPy copy of heights, built on first use
+        self._height_range(0, 0, 0)
+
+    def _height_range(self, level, ix, iz):
+        n = self.cells >> level
+        if level == self.max_level:
+            hs = [h for row in self.heights[iz * n:(iz + 1) * n + 1] for h in row[ix * n:(ix + 1) * n + 1]]
+            rng = (min(hs), max(hs))
+        else:
+            kids = [self._height_range(level + 1, 2 * ix + dx, 2 * iz + dz) for dz in (0, 1) for dx in (0, 1)]
+            rng = (min(k[0] for k in kids), max(k[1] for k in kids))
+        self.ranges[(level, ix, iz)] = rng
+        return rng
+
+    def world_xz(self, gx, gz):
+        half = self.cells / 2
+        return (gx - half) * self.spacing, (gz - half) * self.spacing
+
+    def aabb(self, node):
+        level, ix, iz = node
+        n = self.cells >> level
+        x0, z0 = self.world_xz(ix * n, iz * n)
+        lo, hi = self.ranges[node]
+        return (x0, lo, z0), (x0 + n * self.spacing, hi, z0 + n * self.spacing)
+
+    def _split(self, node, cam_pos):
+        if node[0] == self.max_level:
+            return False
+        mn, mx = self.aabb(node)
+        d = math.sqrt(sum(max(mn[a] - cam_pos[a], 0.0, cam_pos[a] - mx[a]) ** 2 for a in range(3)))
+        limit = self.lod * (self.cells >> node[0]) * self.spacing
+        self.slack = min(self.slack, abs(d - limit))
+        return d < limit
+
+    def select(self, cam_pos):
+        """Mesh of the chunks to draw from cam_pos, one object per chunk, so collect_mesh()
+        frustum-culls them through its BVH and projects them in one batch. Chunks are picked
+        from cam_pos rounded to TERRAIN_SNAP. Distance to an AABB changes no faster than the
+        camera moves, so the mesh is also reused while the rounded position stays within
+        `slack` of the one it was built from."""
+        cam_pos = tuple(round(c / TERRAIN_SNAP) * TERRAIN_SNAP for c in cam_pos)
+        if self.selected is not None and (cam_pos == self.selected[0]
+                                          or math.dist(cam_pos, self.selected[0]) < self.slack):
+            return self.selected[1]
+        self.slack = math.inf
+        leaves = []
+        stack = [(0, 0, 0)]
+        while stack:
+            node = stack.pop()
+            if self._split(node, cam_pos):
+                level, ix, iz = node
+                stack.extend((level + 1, 2 * ix + dx, 2 * iz + dz) for dz in (0, 1) for dx in (0, 1))
+            else:
+                leaves.append(node)
+        chosen = set(leaves)
+        parts = self._chunks([(node, self._seams(node, chosen)) for node in leaves])
+        objects, bounds, fills, edges, offsets, owned = [], [], [], [], [], {}
+        v0 = t0 = 0
+        for node, part in zip(leaves, parts):
+            owned[node] = range(len(objects), len(objects) + len(part.objects))
+            objects.extend((a + v0, b + v0, c + t0, d + t0) for a, b, c, d in part.objects)
+            bounds.extend(part.bounds)
+            fills.extend(part.fills)
+            edges.extend(part.edges)
+            offsets.append(v0)
+            v0 += len(part.verts)
+            t0 += len(part.tris)
+        if parts and parts[0].vectorised:
+            verts = np.concatenate([p.verts for p in parts])
+            tris = np.concatenate([p.tris + o for p, o in zip(parts, offsets)])
+            normals = np.concatenate([p.normals for p in parts])
+            plane_d = np.concatenate([p.plane_d for p in parts])
+        else:
+            verts = [v for p in parts for v in p.verts]
+            tris = [(a + o, b + o, c + o) for p, o in zip(parts, offsets) for a, b, c in p.tris]
+            normals = [n for p in parts for n in p.normals]
+            plane_d = [d for p in parts for d in p.plane_d]
+        mesh = Mesh(verts, tris, normals, plane_d, fills, edges, objects, bounds, self._bvh(owned, bounds))
+        self.selected = (cam_pos, mesh)
+        return mesh
+
+    def _bvh(self, owned, bounds):
+        """build_bvh() nodes that follow the quadtree: each split node becomes a pair of pairs of
+        its children, and subtrees owning at most BVH_LEAF_SIZE mesh objects become leaves."""
+        nodes = []
+
+        def join(node, a, b):
+            (mn_a, mx_a, _, _, items_a), (mn_b, mx_b, _, _, items_b) = nodes[a], nodes[b]
+            nodes[node] = (tuple(map(min, mn_a, mn_b)), tuple(map(max, mx_a, mx_b)), a, b, items_a + items_b)
+
+        def build(node):
+            index = len(nodes)
+            nodes.append(None)
+            items = owned.get(node)
+            if items is None:
+                level, ix, iz = node
+                halves = []
+                for dz in (0, 1):
+                    half = len(nodes)
+                    nodes.append(None)
+                    join(half, build((level + 1, 2 * ix, 2 * iz + dz)), build((level + 1, 2 * ix + 1, 2 * iz + dz)))
+                    halves.append(half)
+                join(index, *halves)
+                mn, mx, _, _, items = nodes[index]
+                if len(items) > BVH_LEAF_SIZE:
+                    return index
+                del nodes[index + 1:]  # the subtree was built after its root; fold it into one leaf
+            else:
+                items = list(items)
+                mn = tuple(min(bounds[i][0][a] for i in items) for a in range(3))
+                mx = tuple(max(bounds[i][1][a] for i in items) for a in range(3))
+            nodes[index] = (mn, mx, -1, -1, items)
+            return index
+
+        build((0, 0, 0))
+        return nodes
+
+    def _seams(self, node, leaves):
+        """Heightmap stride of the coarser chunk among `leaves` on each edge (west, east, north,
+        south), 0 if the neighbour is as fine or finer, or off the map."""
+        level, ix, iz = node
+        step = (self.cells >> level) // self.leaf
+        seams = []
+        for jx, jz in ((ix - 1, iz), (ix + 1, iz), (ix, iz - 1), (ix, iz + 1)):
+            seam = 0
+            for up in range(1, level + 1):
+                if (level - up, jx >> up, jz >> up) in leaves:
+                    seam = step << up
+                    break
+            seams.append(seam)
+        return tuple(seams)
+
+    def _edge_height(self, gx, gz, along_x, stride):
+        """Height on a coarse chunk edge: interpolated between its vertices `stride` samples apart."""
+        g = gx if along_x else gz
+        g0 = g - g % stride
+        g1 = min(g0 + stride, self.cells)
+        if g1 == g0:
+            return self.heights[gz][gx]
+        h0 = self.heights[gz][g0] if along_x else self.heights[g0][gx]
+        h1 = self.heights[gz][g1] if along_x else self.heights[g1][gx]
+        return h0 + (h1 - h0) * (g - g0) / (g1 - g0)
+
+    def _edge_heights(self, gx, gz, along_x, stride):
+        """_edge_height() over NumPy arrays of heightmap points and strides."""
+        hs = self._height_grid()
+        g = gx if along_x else gz
+        g0 = g - g % stride
+        g1 = np.minimum(g0 + stride, self.cells)
+        h0 = hs[gz, g0] if along_x else hs[g0, gx]
+        h1 = hs[gz, g1] if along_x else hs[g1, gx]
+        return np.where(g1 == g0, hs[gz, gx], h0 + (h1 - h0) * (g - g0) / np.maximum(g1 - g0, 1))
+
+    def _chunks(self, keys):
+        """Meshes of (node, seams) chunks from the LRU cache; misses are built together, in one
+        batch of array operations when the batched vertex stage is on."""
+        cache = self.cache
+        missing = [key for key in keys if key not in cache]
+        if missing and USE_NUMPY and np is not None:
+            cache.update(zip(missing, self._chunk_meshes(missing)))
+        elif missing:
+            cache.update((key, compile_mesh(self._chunk_scene(*key))) for key in missing)
+        parts = []
+        for key in keys:
+            cache.move_to_end(key)
+            parts.append(cache[key])
+        while len(cache) > TERRAIN_CACHE:
+            cache.popitem(last=False)
+        return parts
+
+    def _chunk_meshes(self, keys):
+        """One Mesh per (node, seams) key, the heights, seams and faces of all of them computed
+        together (the NumPy version of _chunk_scene())."""
+        k, m, t = len(keys), self.leaf + 1, 2 * self.leaf * self.leaf
+        level = np.array([node[0] for node, _ in keys])
+        n = self.cells >> level
+        step = (n // self.leaf)[:, None]
+        gx = (np.array([node[1] for node, _ in keys]) * n)[:, None] + np.arange(m) * step
+        gz = (np.array([node[2] for node, _ in keys]) * n)[:, None] + np.arange(m) * step
+        h = self._height_grid()[gz[:, :, None], gx[:, None, :]]  # [chunk, row along z, column along x]
+        seams = np.array([seam for _, seam in keys])
+        # Rows (north, south) first, so west/east win the corners as in _chunk_scene().
+        for side, row in ((2, 0), (3, -1)):
+            stride = seams[:, side:side + 1]
+            edge = self._edge_heights(gx, gz[:, [row]], True, np.maximum(stride, 1))
+            h[:, row] = np.where(stride > 0, edge, h[:, row])
+        for side, col in ((0, 0), (1, -1)):
+            stride = seams[:, side:side + 1]
+            edge = self._edge_heights(gx[:, [col]], gz, False, np.maximum(stride, 1))
+            h[:, :, col] = np.where(stride > 0, edge, h[:, :, col])
+        x, z = self.world_xz(gx, gz)
+        verts = np.stack(np.broadcast_arrays(x[:, None, :], h, z[:, :, None]), axis=-1)
+        verts = verts.reshape(k, m * m, 3).astype(np.float32)
+        a = (np.arange(self.leaf)[:, None] * m + np.arange(self.leaf)).ravel()
+        # Quad (a, b, c, d) = rows j, j+1 by columns i, i+1, split as (a, b, c) and (c, b, d).
+        tris = np.stack((a, a + m, a + 1, a + 1, a + m, a + m + 1), axis=1).reshape(-1, 3).astype(np.int32)
+        avg = ((h[:, :-1, :-1] + h[:, 1:, :-1] + h[:, :-1, 1:] + h[:, 1:, 1:]) * 0.25).ravel().tolist()
+        colors = np.array([terrain_color(v) for v in avg for _ in (0, 1)], dtype=np.float32)
+        normals, plane_d, fills, edges = _bake_faces(
+            verts.reshape(-1, 3), (tris + (np.arange(k) * m * m)[:, None, None]).reshape(-1, 3), colors)
+        lo, hi = verts.min(axis=1).tolist(), verts.max(axis=1).tolist()
+        return [Mesh(verts[c], tris, normals[c * t:(c + 1) * t], plane_d[c * t:(c + 1) * t],
+                     fills[c * t:(c + 1) * t], edges[c * t:(c + 1) * t], [(0, m * m, 0, t)],
+                     [(tuple(lo[c]), tuple(hi[c]))]) for c in range(k)]
+
+    def _chunk_scene(self, node, seams):
+        level, ix, iz = node
+        n = self.cells >> level
+        step = n // self.leaf
+        west, east, north, south = seams
+        grid = []
+        for j in range(self.leaf + 1):
+            gz = iz * n + j * step
+            row = []
+            for i in range(self.leaf + 1):
+                gx = ix * n + i * step
+                h = self.heights[gz][gx]
+                if i == 0 and west or i == self.leaf and east:
+                    h = self._edge_height(gx, gz, False, west if i == 0 else east)
+                elif j == 0 and north or j == self.leaf and south:
+                    h = self._edge_height(gx, gz, True, north if j == 0 else south)
+                x, z = self.world_xz(gx, gz)
+                row.append((x, h, z))
+            grid.append(row)
+        bands = {}
+        for j in range(self.leaf):
+            for i in range(self.leaf):
+                a, b, c, d = grid[j][i], grid[j + 1][i], grid[j][i + 1], grid[j + 1][i + 1]
+                tris = bands.setdefault(terrain_color((a[1] + b[1] + c[1] + d[1]) * 0.25), [])
+                tris.append((a, b, c))
+                tris.append((c, b, d))
+        return [(tris, color) for color, tris in bands.items()]
+
+    def height_at(self, x, z):
+        """Ground height under (x, z) on the full-resolution mesh, or None off the map."""
+        half = self.cells / 2
+        fx, fz = x / self.spacing + half, z / self.spacing + half
+        if not (0 <= fx <= self.cells and 0 <= fz <= self.cells):
+            return None
+        gx, gz = min(int(fx), self.cells - 1), min(int(fz), self.cells - 1)
+        u, v = fx - gx, fz - gz
+        hs = self.heights
+        ha, hb, hc, hd = hs[gz][gx], hs[gz + 1][gx], hs[gz][gx + 1], hs[gz + 1][gx + 1]
+        # Same diagonal as the rendered quads: (a, b, c) below it, (c, b, d) above.
+        if u + v <= 1.0:
+            return ha + (hc - ha) * u + (hb - ha) * v
+        return hd + (hb - hd) * (1.0 - u) + (hc - hd) * (1.0 - v)
+
+    def _height_grid(self):
+        if self.grid is None:
+            self.grid = np.array(self.heights, dtype=np.float64)
+        return self.grid
+
+    def heights_at(self, xs, zs):
+        """height_at() over NumPy arrays of points; NaN off the map."""
+        self._height_grid()
+        half = self.cells / 2
+        fx, fz = xs / self.spacing + half, zs / self.spacing + half
+        inside = (fx >= 0) & (fx <= self.cells) & (fz >= 0) & (fz <= self.cells)
+        gx = np.clip(fx, 0, self.cells - 1).astype(np.intp)
+        gz = np.clip(fz, 0, self.cells - 1).astype(np.intp)
+        u, v = fx - gx, fz - gz
+        hs = self.grid
+        ha, hb, hc, hd = hs[gz, gx], hs[gz + 1, gx], hs[gz, gx + 1], hs[gz + 1, gx + 1]
+        h = np.where(u + v <= 1.0, ha + (hc - ha) * u + (hb - ha) * v,
+                     hd + (hb - hd) * (1.0 - u) + (hc - hd) * (1.0 - v))
+        return np.where(inside, h, np.nan)
+
+    def find_floor(self, x, y, z):
+        h = self.height_at(x, z)
+        return h if h is not None and h <= y else None
+
+    def find_ceil(self, x, y, z):
+        return None
+
+    def resolve_walls(self, pos, radius, y0, y1):
+        pass
+
+def terrain_color(h):
+    if h < 2.0:
+        return (34, 139, 34)
+    if h < 8.0:
+        return (80, 150, 50)
+    return (130, 115, 85)
+
+# --- Binary levels (chunked, memory-mapped, streamed) ---
+# Layout, little endian:
+#   header     8s magic, u32 version, u32 chunk count, f32 chunk size
+#   directory  per chunk: i32 cx, i32 cz, 3f min, 3f max, u64 offset, u32 verts, u32 tris, u32 objects
+#   chunk      f32 verts[n][3], u32 tris[n][3], u8 colors[n][3], u32 objects[n][4] (v0, v1, t0, t1)
+LEVEL_MAGIC = b"CSM64LVL"
+LEVEL_VERSION = 1
+LEVEL_HEADER = struct.Struct("<8sIIf")
+LEVEL_ENTRY = struct.Struct("<ii3f3fQIII")
+
+def save_level(path, scene, chunk_size=LEVEL_CHUNK):
+    """Write a scene as a chunked binary level; entries go to the chunk holding their centre."""
+    chunks = {}
+    for tri_list, color in scene:
+        pts = [p for tri in tri_list for p in tri]
+        if not pts:
+            continue
+        key = (math.floor(sum(p[0] for p in pts) / len(pts) / chunk_size),
+               math.floor(sum(p[2] for p in pts) / len(pts) / chunk_size))
+        chunks.setdefault(key, []).append((tri_list, color))
+    blobs = []
+    for (cx, cz), entries in sorted(chunks.items()):
+        verts, tris, colors, objects = [], [], [], []
+        for tri_list, color in entries:
+            index = {}
+            v0, t0 = len(verts), len(tris)
+            for tri in tri_list:
+                ids = []
+                for p in tri:
+                    i = index.get(p)
+                    if i is None:
+                        i = index[p] = len(verts)
+                        verts.append(p)
+                    ids.append(i)
+                tris.append(ids)
+                colors.append(color)
+            objects.append((v0, len(verts), t0, len(tris)))
+        data = b"".join((
+            struct.pack("<%df" % (3 * len(verts)), *(c for p in verts for c in p)),
+            struct.pack("<%dI" % (3 * len(tris)), *(i for t in tris for i in t)),
+            bytes(c for col in colors for c in col),
+            struct.pack("<%dI" % (4 * len(objects)), *(i for o in objects for i in o)),
+        ))
+        mn = tuple(min(p[a] for p in verts) for a in range(3))
+        mx = tuple(max(p[a] for p in verts) for a in range(3))
+        blobs.append((cx, cz, mn, mx, len(verts), len(tris), len(objects), data))
+    offset = LEVEL_HEADER.size + LEVEL_ENTRY.size * len(blobs)
+    with open(path, "wb") as f:
+        f.write(LEVEL_HEADER.pack(LEVEL_MAGIC, LEVEL_VERSION, len(blobs), chunk_size))
+        for cx, cz, mn, mx, nv, nt, no, data in blobs:
+            f.write(LEVEL_ENTRY.pack(cx, cz, *mn, *mx, offset, nv, nt, no))
+            offset += len(data)
+        for blob in blobs:
+            f.write(blob[-1])
+
+def _bake_faces(verts, tris, colors):
+    """Normals, plane offsets and shaded fill/edge colour tuples of NumPy triangles."""
+    a, b, c = verts[tris[:, 0]], verts[tris[:, 1]], verts[tris[:, 2]]
+    normals = np.cross(b - a, c - a)
+    plane_d = np.einsum("ij,ij->i", normals, a)
+    shade = np.clip(0.65 + np.clip(normals[:, 2] * 0.01, -1, 1), 0.35, 1.0)
+    fills = np.minimum(255, colors * shade[:, None]).astype(np.int32)
+    edges = np.minimum(255, fills + 35)
+    return normals, plane_d, [tuple(f) for f in fills.tolist()], [tuple(e) for e in edges.tolist()]
+
+def mesh_from_arrays(verts, tris, colors, objects):
+    """Mesh over NumPy arrays (e.g. views of a mapped level), baking normals and shade in bulk."""
+    normals, plane_d, fills, edges = _bake_faces(verts, tris, colors)
+    bounds = [(tuple(verts[v0:v1].min(axis=0).tolist()), tuple(verts[v0:v1].max(axis=0).tolist()))
+              for v0, v1, _, _ in objects]
+    return Mesh(verts, tris, normals, plane_d, fills, edges, objects, bounds)
+
+class LevelStream:
+    """Memory-mapped chunked level; a background thread keeps chunks near Mario resident.
+
+    Opening only reads the chunk directory and indexes it by chunk_size grid cell. update()
+    hands the loader thread Mario's position whenever he changes cell or has moved
+    STREAM_REPLAN; it maps in the nearest missing chunks within STREAM_RADIUS (vertex and
+    index arrays stay views of the file) and evicts the farthest ones once resident bytes
+    exceed the budget. meshes() and the collision queries only ever see fully loaded chunks.
+    """
+
+    def __init__(self, path, radius=STREAM_RADIUS, budget=STREAM_BUDGET):
+        if np is None:
+            raise RuntimeError("level streaming needs NumPy")
+        self.radius = radius
+        self.budget = budget
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, self.chunk_size = LEVEL_HEADER.unpack_from(self._map, 0)
+        if magic != LEVEL_MAGIC or version != LEVEL_VERSION:
+            raise ValueError("%s is not a version %d level" % (path, LEVEL_VERSION))
+        self.directory = [LEVEL_ENTRY.unpack_from(self._map, LEVEL_HEADER.size + i * LEVEL_ENTRY.size)
+                          for i in range(count)]
+        self._cells = {}  # (gx, gz) grid cell -> chunks whose AABB overlaps it
+        for i, e in enumerate(self.directory):
+            for gx in range(self._cell(e[2]), self._cell(e[5]) + 1):
+                for gz in range(self._cell(e[4]), self._cell(e[7]) + 1):
+                    self._cells.setdefault((gx, gz), []).append(i)
+        self._planned = None  # position the loader last planned from
+        self.resident = {}  # chunk index -> (mesh, SurfaceGrid, bytes)
+        self.resident_bytes = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._focus = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._loader, name="level-stream", daemon=True)
+        self._thread.start()
+
+    def _cell(self, x):
+        return math.floor(x / self.chunk_size)
+
+    def _near(self, pos, radius):
+        """Chunks whose AABB may be within radius of pos (a superset, from the cell index)."""
+        found = set()
+        for gx in range(self._cell(pos[0] - radius), self._cell(pos[0] + radius) + 1):
+            for gz in range(self._cell(pos[2] - radius), self._cell(pos[2] + radius) + 1):
+                found.update(self._cells.get((gx, gz), ()))
+        return found
+
+    def _under(self, pos):
+        return [i for i in self._near(pos, 0.0) if self._distance(i, pos) == 0.0]
+
+    def _distance(self, i, pos):
+        e = self.directory[i]
+        dx = max(e[2] - pos[0], 0.0, pos[0] - e[5])
+        dz = max(e[4] - pos[2], 0.0, pos[2] - e[7])
+        return math.hypot(dx, dz)
+
+    def _load(self, i):
+        cx, cz, x0, y0, z0, x1, y1, z1, offset, nv, nt, no = self.directory[i]
+        mm = self._map
+        verts = np.frombuffer(mm, np.float32, nv * 3, offset).reshape(-1, 3)
+        offset += verts.nbytes
+        tris = np.frombuffer(mm, np.uint32, nt * 3, offset).reshape(-1, 3)
+        offset += tris.nbytes
+        colors = np.frombuffer(mm, np.uint8, nt * 3, offset).reshape(-1, 3)
+        offset += colors.nbytes
+        objects = [tuple(o) for o in np.frombuffer(mm, np.uint32, no * 4, offset).reshape(-1, 4).tolist()]
+        mesh = mesh_from_arrays(verts, tris, colors.astype(np.float32), objects)
+        tri_pts = verts[tris].tolist()
+        grid = SurfaceGrid([([tuple(map(tuple, t)) for t in tri_pts[t0:t1]], None) for _, _, t0, t1 in objects])
+        return mesh, grid, self._chunk_bytes(i)
+
+    def _chunk_bytes(self, i):
+        """Resident cost of a chunk, known from the directory before loading it: vertex, index
+        and colour views, baked normals and plane offsets, plus ~64 bytes of collision per tri."""
+        nv, nt = self.directory[i][9], self.directory[i][10]
+        return 12 * nv + (12 + 12 + 3 + 12 + 4 + 64) * nt
+
+    def _loader(self):
+        while True:
+            with self._wake:
+                while self._focus is None and not self._closed:
+                    self._wake.wait()
+                if self._closed:
+                    return
+                pos, self._focus = self._focus, None
+            wanted = sorted((d, i) for i, d in ((i, self._distance(i, pos)) for i in self._near(pos, self.radius))
+                            if d <= self.radius)
+            for d, i in wanted:
+                if i in self.resident:
+                    continue
+                with self._lock:
+                    spare = self.budget - self.resident_bytes + sum(
+                        r[2] for j, r in self.resident.items() if self._distance(j, pos) > d)
+                if d > 0.0 and self._chunk_bytes(i) > spare:
+                    break  # nearer chunks fill the budget; loading this one would only evict it again
+                mesh, grid, size = self._load(i)
+                with self._lock:
+                    if self._closed:
+                        return
+                    self.resident[i] = (mesh, grid, size)
+                    self.resident_bytes += size
+                    self._evict(pos, keep=i)
+                    if i not in self.resident:
+                        break  # budget exhausted by nearer chunks
+                    if self._focus is not None:
+                        break  # Mario moved on; re-plan from the new position
+
+    def _evict(self, pos, keep):
+        """Drop the farthest chunks until the budget holds. Chunks nearer than `keep` (the one
+        just loaded) and chunks under pos always stay; if that is not enough, keep itself
+        goes, unless it is under pos as well."""
+        limit = self._distance(keep, pos)
+        for i in sorted(self.resident, key=lambda i: -self._distance(i, pos)):
+            if self.resident_bytes <= self.budget:
+                return
+            d = self._distance(i, pos)
+            if d < limit or d == 0.0:
+                break
+            if i != keep:
+                self.resident_bytes -= self.resident.pop(i)[2]
+        if self.resident_bytes > self.budget and limit > 0.0:
+            self.resident_bytes -= self.resident.pop(keep)[2]
+
+    def update(self, pos):
+        """Wake the loader if Mario changed grid cell or moved STREAM_REPLAN since its last plan."""
+        last = self._planned
+        if (last is not None and self._cell(pos[0]) == self._cell(last[0]) and self._cell(pos[2]) == self._cell(last[2])
+                and math.hypot(pos[0] - last[0], pos[2] - last[2]) < STREAM_REPLAN):
+            return
+        self._planned = tuple(pos)
+        with self._wake:
+            self._focus = self._planned
+            self._wake.notify()
+
+    def preload(self, pos):
+        """Synchronously load the chunk under pos so the level is playable immediately."""
+        for i in self._under(pos):
+            if i not in self.resident:
+                mesh, grid, size = self._load(i)
+                with self._lock:
+                    self.resident[i] = (mesh, grid, size)
+                    self.resident_bytes += size
+        self._planned = None
+        self.update(pos)
+
+    def ready_at(self, pos):
+        """False while the chunk under pos is still streaming in."""
+        under = self._under(pos)
+        with self._lock:
+            return all(i in self.resident for i in under)
+
+    def meshes(self):
+        with self._lock:
+            return [r[0] for r in self.resident.values()]
+
+    def _grids(self, x, z):
+        with self._lock:
+            return [r[1] for i, r in self.resident.items() if self._distance(i, (x, 0.0, z)) <= MARIO_RADIUS]
+
+    def find_floor(self, x, y, z):
+        hs = [h for h in (g.find_floor(x, y, z) for g in self._grids(x, z)) if h is not None]
+        return max(hs) if hs else None
+
+    def find_ceil(self, x, y, z):
+        hs = [h for h in (g.find_ceil(x, y, z) for g in self._grids(x, z)) if h is not None]
+        return min(hs) if hs else None
+
+    def resolve_walls(self, pos, radius, y0, y1):
+        for g in self._grids(pos[0], pos[2]):
+            g.resolve_walls(pos, radius, y0, y1)
+
+    def close(self):
+        with self._wake:
+            self._closed = True
+            self._wake.notify()
+        self._thread.join()
+        self.resident.clear()
+        self._file.close()
+        try:
+            self._map.close()
+        except BufferError:
+            pass  # callers still hold mesh views; the mapping goes away with them
+
+# --- Save files (one small binary record per slot, written off-thread) ---
+# Layout, little endian: 8s magic, u32 version, u16 stars, u32 flags, 3f Mario position,
+# then u32 CRC-32 of everything before it.
+SAVE_MAGIC = b"CSM64SAV"
+SAVE_VERSION = 1
+SAVE_RECORD = struct.Struct("<8sIHI3f")
+SAVE_CRC = struct.Struct("<I")
+
+class SaveData:
+    """One file's progress: star count, progress flag bits and where Mario was."""
+
+    def __init__(self, stars=0, flags=0, pos=MARIO_SPAWN):
+        self.stars = stars
+        self.flags = flags
+        self.pos = tuple(pos)
+
+def pack_save(data):
+    body = SAVE_RECORD.pack(SAVE_MAGIC, SAVE_VERSION, data.stars, data.flags, *data.pos)
+    return body + SAVE_CRC.pack(zlib.crc32(body))
+
+def unpack_save(blob):
+    """SaveData from a packed record, or None if it is short, foreign, outdated or corrupt."""
+    if len(blob) != SAVE_RECORD.size + SAVE_CRC.size:
+        return None
+    body = blob[:SAVE_RECORD.size]
+    if SAVE_CRC.unpack_from(blob, SAVE_RECORD.size)[0] != zlib.crc32(body):
+        return None
+    magic, version, stars, flags, x, y, z = SAVE_RECORD.unpack(body)
+    if magic != SAVE_MAGIC or version != SAVE_VERSION:
+        return None
+    return SaveData(stars, flags, (x, y, z))
+
+def save_path(slot, directory=SAVE_DIR):
+    return os.path.join(directory, "slot%d.sav" % (slot + 1))
+
+def load_saves(directory=SAVE_DIR, slots=3):
+    """SaveData (or None for an empty or unreadable slot) for every file select slot."""
+    saves = []
+    for slot in range(slots):
+        try:
+            with open(save_path(slot, directory), "rb") as f:
+                saves.append(unpack_save(f.read()))
+        except OSError:
+            saves.append(None)
+    return saves
+
+def write_atomic(path, data):
+    """Replace path with data so that a crash leaves either the old or the new file."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+class SaveWriter:
+    """Writes save slots on a background thread so autosaves never stall a frame.
+
+    save() only packs the record and hands it over. When the disk falls behind, a newer
+    save of a slot replaces the pending one instead of queueing. Every write goes through
+    write_atomic(). A failed write is kept in `error` rather than raised into the game loop.
+    """
+
+    def __init__(self, directory=SAVE_DIR):
+        self.directory = directory
+        self.pending = {}  # slot -> packed record
+        self.written = 0
+        self.error = None
+        self._busy = False
+        self._closed = False
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._thread = threading.Thread(target=self._writer, name="save-writer", daemon=True)
+        self._thread.start()
+
+    def save(self, slot, data):
+        blob = pack_save(data)
+        with self._wake:
+            self.pending[slot] = blob
+            self._wake.notify_all()
+
+    def _writer(self):
+        while True:
+            with self._wake:
+                while not self.pending and not self._closed:
+                    self._wake.wait()
+                if not self.pending:
+                    return
+                slot, blob = self.pending.popitem()
+                self._busy = True
+            try:
+                write_atomic(save_path(slot, self.directory), blob)
+                self.written += 1
+            except OSError as e:
+                self.error = e
+            with self._wake:
+                self._busy = False
+                self._wake.notify_all()
+
+    def flush(self):
+        """Block until every save handed over so far is on disk (or has failed)."""
+        with self._wake:
+            while self.pending or self._busy:
+                self._wake.wait()
+
+    def close(self):
+        """Finish pending writes and stop the thread."""
+        with self._wake:
+            self._closed = True
+            self._wake.notify_all()
+        self._thread.join()
+
+# --- Frame profiler ---
+PROFILE_HISTORY = 600  # frames kept for the overlay and for export
+
+class FrameProfiler:
+    """Per-frame stage spans plus triangle counters.
+
+    The loop calls begin(), mark(stage) after each stage and end(). Callers pass None
+    instead of a profiler when profiling is off, so the disabled cost is one `is None`
+    test per stage. Frames are kept in a bounded ring for the overlay, CSV export and
+    Chrome trace export (chrome://tracing or Perfetto).
+    """
+
+    def __init__(self, history=PROFILE_HISTORY):
+        self.frames = deque(maxlen=history)
+        self.stages = {}
+        self.counts = {}
+        self.spans = []
+        self._start = self._last = 0.0
+
+    def begin(self):
+        self.stages = {}
+        self.spans = []
+        self.counts = {"submitted": 0, "drawn": 0}
+        self._start = self._last = time.perf_counter()
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.stages[stage] = self.stages.get(stage, 0.0) + now - self._last
+        self.spans.append((stage, self._last, now - self._last))
+        self._last = now
+
+    def end(self):
+        self.frames.append((self._start, self._last - self._start, self.stages, self.counts, self.spans))
+
+    def report(self, last=None):
+        frames = list(self.frames)[-last:] if last else self.frames
+        times = sorted(f[1] for f in frames)
+        n = max(1, len(times))
+
+        def pct(q):
+            return times[min(len(times) - 1, int(q * len(times)))] * 1000.0 if times else 0.0
+
+        total = sum(times) or 1.0
+        stages = {}
+        counts = {}
+        for _, _, st, c, _ in frames:
+            for k, v in st.items():
+                stages[k] = stages.get(k, 0.0) + v
+            for k, v in c.items():
+                counts[k] = counts.get(k, 0) + v
+        counts["culled"] = counts.get("submitted", 0) - counts.get("drawn", 0) - counts.get("impostored", 0)
+        return {
+            "frames": len(times),
+            "fps": n / total,
+            "frame_ms": {"mean": total / n * 1000.0, "p50": pct(0.5), "p90": pct(0.9), "p99": pct(0.99),
+                         "max": times[-1] * 1000.0 if times else 0.0},
+            "tris_per_frame": {k: v / n for k, v in counts.items()},
+            "stage_ms": {k: v / n * 1000.0 for k, v in stages.items()},
+        }
+
+    def export_csv(self, path):
+        names = []
+        for _, _, st, _, _ in self.frames:
+            names.extend(k for k in st if k not in names)
+        with open(path, "w") as f:
+            f.write(",".join(["frame", "start_s", "total_ms"] + [k + "_ms" for k in names]
+                             + ["submitted", "culled", "drawn", "impostored"]) + "\n")
+            for i, (start, total, st, c, _) in enumerate(self.frames):
+                row = [str(i), "%.6f" % start, "%.3f" % (total * 1000.0)]
+                row += ["%.3f" % (st.get(k, 0.0) * 1000.0) for k in names]
+                imp = c.get("impostored", 0)
+                row += [str(c["submitted"]), str(c["submitted"] - c["drawn"] - imp), str(c["drawn"]), str(imp)]
+                f.write(",".join(row) + "\n")
+
+    def export_trace(self, path):
+        events = []
+        for i, (start, total, _, c, spans) in enumerate(self.frames):
+            events.append({"name": "frame %d" % i, "ph": "X", "pid": 1, "tid": 1,
+                           "ts": start * 1e6, "dur": total * 1e6})
+            for stage, t0, dur in spans:
+                events.append({"name": stage, "ph": "X", "pid": 1, "tid": 1, "ts": t0 * 1e6, "dur": dur * 1e6})
+            events.append({"name": "triangles", "ph": "C", "pid": 1, "ts": start * 1e6,
+                           "args": {"drawn": c["drawn"], "impostored": c.get("impostored", 0),
+                                    "culled": c["submitted"] - c["drawn"] - c.get("impostored", 0)}})
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+def draw_profiler_overlay(screen, prof, frames=60):
+    """Averages over the last `frames` frames: frame time, per-stage bars and triangle counts."""
+    if not prof.frames:
+        return
+    rep = prof.report(frames)
+    ft = rep["frame_ms"]
+    stages = rep["stage_ms"]
+    panel = pygame.Surface((300, 58 + 18 * len(stages)), pygame.SRCALPHA)
+    panel.fill((0, 0, 0, 160))
+    screen.blit(panel, (W - 310, 10))
+    x, y = W - 300, 16
+    screen.blit(render_text("frame %.1f ms  p99 %.1f  %.0f fps" % (ft["mean"], ft["p99"], rep["fps"]),
+                            20, (255, 255, 255)), (x, y))
+    tr = rep["tris_per_frame"]
+    screen.blit(render_text("tris  %d sub  %d cull  %d drawn" % (tr["submitted"], tr["culled"], tr["drawn"]),
+                            20, (200, 200, 200)), (x, y + 18))
+    y += 40
+    for name, ms in stages.items():
+        width = int(160 * ms / max(1e-6, ft["mean"]))
+        pygame.draw.rect(screen, (90, 200, 120), (x + 120, y + 3, max(1, width), 10))
+        screen.blit(render_text("%-9s %5.2f" % (name, ms), 20, (230, 230, 230)), (x, y))
+        y += 18
+
+# --- Simulation (no pygame) ---
+def update_mario(target_pos, vy, move, yaw, dt, world=None):
+    """Camera-relative WASD movement, jump and gravity; move is (fwd, back, left, right, jump).
+
+    With a SurfaceGrid, Mario lands on floors, slides along walls, bumps ceilings and
+    respawns below KILL_Y; without one the flat GROUND_Y plane is the only collision.
+    """
+    fwd, back, left, right, jump = move
+    cy, sy = math.cos(yaw), math.sin(yaw)
+    move_speed = CAM_SPEED * dt
+    if fwd:
+        target_pos[0] -= sy * move_speed
+        target_pos[2] -= cy * move_speed
+    if back:
+        target_pos[0] += sy * move_speed
+        target_pos[2] += cy * move_speed
+    if left:
+        target_pos[0] -= cy * move_speed
+        target_pos[2] += sy * move_speed
+    if right:
+        target_pos[0] += cy * move_speed
+        target_pos[2] -= sy * move_speed
+    if world is None:
+        ground = GROUND_Y
+    else:
+        world.resolve_walls(target_pos, MARIO_RADIUS, target_pos[1] - MARIO_HALF_HEIGHT + STEP_HEIGHT,
+                            target_pos[1] + MARIO_HEAD)
+        floor = world.find_floor(target_pos[0], target_pos[1] - MARIO_HALF_HEIGHT + STEP_HEIGHT, target_pos[2])
+        ground = floor + MARIO_HALF_HEIGHT if floor is not None else -math.inf
+    on_ground = target_pos[1] <= ground + 0.01
+    if jump and on_ground:
+        vy = JUMP_VELOCITY
+    vy += GRAVITY * dt
+    target_pos[1] += vy * dt
+    if world is not None and vy > 0:
+        ceil = world.find_ceil(target_pos[0], target_pos[1] - MARIO_HALF_HEIGHT, target_pos[2])
+        if ceil is not None and target_pos[1] + MARIO_HEAD > ceil:
+            target_pos[1] = ceil - MARIO_HEAD
+            vy = 0.0
+    if target_pos[1] <= ground:
+        target_pos[1] = ground
+        vy = 0.0
+    elif target_pos[1] < KILL_Y:
+        target_pos[:] = MARIO_SPAWN
+        vy = 0.0
+    return vy
+
+class MarioState:
+    """What the simulation carries from one step to the next."""
+
+    def __init__(self, pos=MARIO_SPAWN, vy=0.0):
+        self.pos = list(pos)
+        self.vy = vy
+
+def step(state, inputs, dt, world=None):
+    """Advance one MarioState by dt and return the next one; state is left untouched.
+
+    inputs is (fwd, back, left, right, jump, yaw): the move buttons plus the camera yaw that
+    movement is relative to. Needs neither pygame nor a display, so bots and playtests can
+    drive it directly.
+    """
+    pos = list(state.pos)
+    vy = update_mario(pos, state.vy, inputs[:5], inputs[5], dt, world)
+    return MarioState(pos, vy)
+
+def _step_arrays(pos, vy, inputs, dt, terrain=None):
+    """update_mario() for every row of pos (n, 3) and vy (n,) at once, in place, on flat
+    GROUND_Y or a Terrain (neither has walls or ceilings)."""
+    fwd, back, left, right, jump = (inputs[:, :5] != 0).T
+    yaw = inputs[:, 5]
+    cy, sy = np.cos(yaw), np.sin(yaw)
+    move_speed = CAM_SPEED * dt
+    x, y, z = pos[:, 0], pos[:, 1], pos[:, 2]
+    x -= sy * move_speed * fwd
+    z -= cy * move_speed * fwd
+    x += sy * move_speed * back
+    z += cy * move_speed * back
+    x -= cy * move_speed * left
+    z += sy * move_speed * left
+    x += cy * move_speed * right
+    z -= sy * move_speed * right
+    if terrain is None:
+        ground = np.full(len(vy), GROUND_Y)
+    else:
+        floor = terrain.heights_at(x, z)
+        ground = np.where(floor <= y - MARIO_HALF_HEIGHT + STEP_HEIGHT, floor + MARIO_HALF_HEIGHT, -np.inf)
+    on_ground = y <= ground + 0.01
+    vy[jump & on_ground] = JUMP_VELOCITY
+    vy += GRAVITY * dt
+    y += vy * dt
+    landed = y <= ground
+    y[landed] = ground[landed]
+    vy[landed] = 0.0
+    fallen = ~landed & (y < KILL_Y)
+    pos[fallen] = MARIO_SPAWN
+    vy[fallen] = 0.0
+
+def _step_slice(world, pos, vy, inputs, dt, steps):
+    """Scalar path: update_mario() each Mario of a slice `steps` times."""
+    for _ in range(steps):
+        for i, (p, move) in enumerate(zip(pos, inputs)):
+            vy[i] = update_mario(p, vy[i], move[:5], move[5], dt, world)
+    return pos, vy
+
+_sim_world = None  # the world of a SimBatch pool worker process
+
+def _init_sim_worker(world):
+    global _sim_world
+    _sim_world = world
+
+def _pool_step_slice(pos, vy, inputs, dt, steps):
+    return _step_slice(_sim_world, pos, vy, inputs, dt, steps)
+
+class SimBatch:
+    """n independent Marios stepped together, for bots and automated playtesting.
+
+    With no world (flat GROUND_Y) or a bare Terrain, each step is a few NumPy array ops over
+    all n at once. Other worlds (SurfaceGrid, CombinedWorld) need the scalar collision code,
+    so the batch is split across `workers` processes, each holding its own copy of the
+    world (streamed levels can't be copied). pos is (n, 3) and vy (n,): NumPy arrays when
+    NumPy is available, otherwise lists.
+    """
+
+    def __init__(self, n, world=None, workers=0):
+        self.world = world
+        self.vectorised = np is not None and (world is None or isinstance(world, Terrain))
+        if np is not None:
+            self.pos = np.tile(np.array(MARIO_SPAWN, dtype=np.float64), (n, 1))
+            self.vy = np.zeros(n)
+        else:
+            self.pos = [list(MARIO_SPAWN) for _ in range(n)]
+            self.vy = [0.0] * n
+        self.workers = workers if not self.vectorised else 0
+        self.pool = None
+        if self.workers > 0:
+            self.pool = ProcessPoolExecutor(self.workers, initializer=_init_sim_worker, initargs=(world,))
+
+    def step(self, inputs, dt=1.0 / SIM_HZ, steps=1):
+        """Advance every Mario `steps` times (action repeat) with one (fwd, back, left,
+        right, jump, yaw) row of inputs per Mario."""
+        if self.vectorised:
+            inputs = np.asarray(inputs, dtype=np.float64)
+            for _ in range(steps):
+                _step_arrays(self.pos, self.vy, inputs, dt, self.world)
+            return
+        rows = inputs.tolist() if hasattr(inputs, "tolist") else list(inputs)
+        pos = self.pos.tolist() if np is not None else self.pos
+        vy = self.vy.tolist() if np is not None else self.vy
+        if self.pool is None:
+            pos, vy = _step_slice(self.world, pos, vy, rows, dt, steps)
+            self.pos[:], self.vy[:] = pos, vy
+            return
+        size = -(-len(vy) // self.workers)
+        starts = range(0, len(vy), size)
+        futures = [self.pool.submit(_pool_step_slice, pos[a:a + size], vy[a:a + size], rows[a:a + size], dt, steps)
+                   for a in starts]
+        for a, fut in zip(starts, futures):
+            p, v = fut.result()
+            self.pos[a:a + len(v)] = p
+            self.vy[a:a + len(v)] = v
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+# --- Game loop ---
+def read_move_keys(keys):
+    return (keys[pygame.K_w], keys[pygame.K_s], keys[pygame.K_a], keys[pygame.K_d], keys[pygame.K_SPACE])
+
+class FixedStep:
+    """Fixed-rate simulation clock for a variable-rate render loop.
+
+    advance() banks real frame time and returns how many SIM_HZ steps to run. When
+    rendering falls behind, several steps run per rendered frame (frame skipping) so the
+    simulation keeps real-time pace; beyond MAX_SIM_STEPS the backlog is dropped rather
+    than letting slow frames snowball. alpha is the leftover fraction of a step, used to
+    interpolate between the previous and current simulation states.
+    """
+
+    def __init__(self, hz=SIM_HZ, max_steps=MAX_SIM_STEPS):
+        self.dt = 1.0 / hz
+        self.max_steps = max_steps
+        self.acc = 0.0
+        self.dropped = 0.0
+
+    def advance(self, frame_dt):
+        self.acc += frame_dt
+        steps = min(self.max_steps, int(self.acc / self.dt + 1e-9))
+        self.acc -= steps * self.dt
+        if self.acc >= self.dt:
+            self.dropped += self.acc - self.acc % self.dt
+            self.acc %= self.dt
+        return steps
+
+    @property
+    def alpha(self):
+        return self.acc / self.dt
+
+def lerp_pos(a, b, t):
+    return [a[0] + (b[0] - a[0]) * t, a[1] + (b[1] - a[1]) * t, a[2] + (b[2] - a[2]) * t]
+
+class ResolutionScaler:
+    """Frame-time controller for the render scale of the 3D pass.
+
+    update() takes each frame's busy time (not the frame-cap sleep) and smooths it. Over
+    90% of the budget the scale drops in proportion to sqrt(budget / time), since fill cost
+    follows pixel count; under 60% it climbs back one step at a time. After each change it
+    holds for `hold` frames so the new cost shows up in the average before it moves again.
+    """
+
+    def __init__(self, budget=FRAME_BUDGET, lo=RENDER_SCALE_MIN, step=RENDER_SCALE_STEP, hold=30):
+        self.budget = budget
+        self.lo = lo
+        self.step = step
+        self.hold = hold
+        self.scale = 1.0
+        self.avg = budget * 0.75
+        self.wait = 0
+
+    def update(self, work):
+        self.avg += (work - self.avg) * 0.1
+        if self.wait > 0:
+            self.wait -= 1
+            return self.scale
+        scale = self.scale
+        if self.avg > self.budget * 0.9:
+            scale *= math.sqrt(self.budget * 0.75 / self.avg)
+            scale = math.floor(scale / self.step + 1e-6) * self.step
+        elif self.avg < self.budget * 0.6:
+            scale += self.step
+        scale = round(max(self.lo, min(1.0, scale)), 4)
+        if scale != self.scale:
+            self.scale = scale
+            self.wait = self.hold
+        return self.scale
+
+class FrameCoherence:
+    """The last finished 3D image, kept once the view has stayed put for a frame and
+    re-presented for as long as camera, actors, meshes, backend, scale and window all
+    stay the same (e.g. Mario idle and no mouse input)."""
+
+    def __init__(self):
+        self.key = None
+        self.frame = None
+        self.info = None
+        self.reused = 0
+
+def render_frame(screen, meshes, instances, target_pos, cam_rot, backend, zbuf, prof=None, pool=None, scale=1.0,
+                 terrain=None, coherence=None, impostors=None):
+    """Sky plus the 3D pass (static meshes, terrain chunks and model instances), drawn at
+    `scale` of the window size and scaled up to fill it; returns HUD info text (z-buffer
+    stats) or None. With a FrameCoherence, unchanged frames skip the 3D pass entirely; with
+    an ImpostorCache, distant objects of `meshes` are drawn as sprites."""
+    cam_pos = orbit_camera_pos(target_pos, cam_rot[1], cam_rot[0], CAM_DISTANCE)
+    if prof is not None:
+        prof.mark("camera")
+    if coherence is not None:
+        key = (screen.get_size(), tuple(cam_pos), tuple(cam_rot), backend, scale, tuple(meshes),
+               tuple((inst, inst.pos, inst.yaw, inst.scale) for inst in instances))
+        still = key == coherence.key
+        coherence.key = key
+        if still and coherence.frame is not None:
+            screen.blit(coherence.frame, (0, 0))
+            coherence.reused += 1
+            if prof is not None:
+                prof.mark("reuse")
+            return coherence.info
+    view = view_surface(screen, scale)
+    scale = view.get_width() / W
+    draw_sky(view)
+    if prof is not None:
+        prof.mark("sky")
+    planes = view_frustum(cam_pos, cam_rot)
+    # Terrain chunks are already LOD'd, so only level meshes get impostors.
+    jobs = [(mesh, impostors) for mesh in meshes]
+    if terrain is not None:
+        jobs.append((terrain.select(cam_pos), None))
+    if impostors is not None:
+        impostors.begin()
+    to_draw = []
+    stats = prof.counts if prof is not None else None
+    if pool is not None and pool.threaded and len(jobs) > 1:
+        def collect(job):
+            part = []
+            counts = {"submitted": 0, "drawn": 0, "impostored": 0}
+            collect_mesh(job[0], cam_pos, cam_rot, part, planes, counts, scale, job[1])
+            return part, counts
+
+        for part, counts in pool.map(collect, jobs):
+            to_draw.extend(part)
+            if stats is not None:
+                stats["submitted"] += counts["submitted"]
+                stats["drawn"] += counts["drawn"]
+                if counts["impostored"]:
+                    stats["impostored"] = stats.get("impostored", 0) + counts["impostored"]
+    else:
+        for mesh, imp in jobs:
+            collect_mesh(mesh, cam_pos, cam_rot, to_draw, planes, stats, scale, imp)
+    collect_instances(instances, cam_pos, cam_rot, to_draw, planes, stats, scale)
+    sprites = impostors.queued if impostors is not None else ()
+    if stats is not None and sprites:
+        stats["impostors"] = stats.get("impostors", 0) + len(sprites)
+    if prof is not None:
+        prof.mark("transform")
+    if backend == "zbuffer":
+        raster_queued(zbuf, view, to_draw, pool, sprites)
+        info = zbuf.stats_text()
+    else:
+        to_draw.extend(sprites)
+        sort_queued(to_draw)
+        if prof is not None:
+            prof.mark("sort")
+        draw_queued(view, to_draw)
+        info = None
+    if prof is not None:
+        prof.mark("raster")
+    if view is not screen:
+        pygame.transform.scale(view, screen.get_size(), screen)
+        if prof is not None:
+            prof.mark("upscale")
+    if coherence is not None:
+        # Only a view that was already still last frame is worth the copy.
+        coherence.frame = screen.copy() if still else None
+        coherence.info = info
+    return info
+
+def wait_events():
+    """Block until something happens (no idle repaint), then drain the queue."""
+    return [pygame.event.wait()] + pygame.event.get()
+
+def run(level_path=None, save_dir=SAVE_DIR):
     global W, H
     pygame.init()
     screen = pygame.display.set_mode((W, H), pygame.RESIZABLE)
     pygame.display.set_caption(f"Cat's ! SM64 {VERSION}")
     clock = pygame.time.Clock()
 
-    # Part 1: Title screen
+    # Part 1: Title screen (static: drawn once, then redrawn only on resize/expose)
     in_menu = True
+    redraw = True
     while in_menu:
-        for e in pygame.event.get():
+        if redraw:
+            draw_menu(screen)
+            pygame.display.flip()
+            redraw = False
+        for e in wait_events():
             if e.type == pygame.QUIT:
-                pygame.quit()
+                shutdown()
                 return
             if e.type == pygame.VIDEORESIZE:
                 W, H = e.w, e.h
                 screen = pygame.display.set_mode((W, H), pygame.RESIZABLE)
+                clear_backgrounds()
+                clear_views()
+                redraw = True
+            if e.type == pygame.WINDOWEXPOSED:
+                redraw = True
             if e.type == pygame.KEYDOWN and e.key in (pygame.K_SPACE, pygame.K_RETURN, pygame.K_KP_ENTER):
                 in_menu = False
             if e.type == pygame.MOUSEBUTTONDOWN:
                 in_menu = False
-        draw_menu(screen)
-        pygame.display.flip()
-        clock.tick(60)
 
-    # Part 2: File select
-    file_stars = [0, 0, 0]
+    # Part 2: File select (only the old and new selected slots are repainted on input)
+    saves = load_saves(save_dir)
+    file_stars = [save.stars if save is not None else None for save in saves]
     selected_file = 0
     in_file_select = True
+    redraw = True
     while in_file_select:
-        for e in pygame.event.get():
+        if redraw:
+            draw_file_select(screen, selected_file, file_stars)
+            pygame.display.flip()
+            redraw = False
+        dirty = []
+        for e in wait_events():
             if e.type == pygame.QUIT:
-                pygame.quit()
+                shutdown()
                 return
             if e.type == pygame.VIDEORESIZE:
                 W, H = e.w, e.h
                 screen = pygame.display.set_mode((W, H), pygame.RESIZABLE)
+                clear_backgrounds()
+                clear_views()
+                redraw = True
+            if e.type == pygame.WINDOWEXPOSED:
+                redraw = True
             if e.type == pygame.KEYDOWN:
+                old = selected_file
                 if e.key in (pygame.K_LEFT, pygame.K_a):
                     selected_file = (selected_file - 1) % 3
                 elif e.key in (pygame.K_RIGHT, pygame.K_d):
                     selected_file = (selected_file + 1) % 3
                 elif e.key in (pygame.K_SPACE, pygame.K_RETURN, pygame.K_KP_ENTER):
                     in_file_select = False
-        draw_file_select(screen, selected_file, file_stars)
-        pygame.display.flip()
-        clock.tick(60)
+                if selected_file != old:
+                    dirty.append(draw_file_slot(screen, old, selected_file, file_stars))
+                    dirty.append(draw_file_slot(screen, selected_file, selected_file, file_stars))
+        if dirty and not redraw:
+            pygame.display.update(dirty)
 
     # Part 3: Game
-    target_pos = [0.0, GROUND_Y, 0.0]
-    vy = 0.0
+    run_game(screen, clock, level_path, selected_file, saves[selected_file], save_dir)
+
+def run_game(screen, clock, level_path=None, slot=0, save=None, save_dir=SAVE_DIR):
+    global W, H
+    if save is None:
+        save = SaveData()
+    # Saved positions are in the castle; a streamed level starts at the spawn and keeps the slot's.
+    state = prev = MarioState(MARIO_SPAWN if level_path else save.pos)
     cam_rot = [0.0, 0.0]
-    scene = get_castle_scene()
+    sim = FixedStep()
+    terrain = None
+    if level_path:
+        world = stream = LevelStream(level_path)
+        stream.preload(state.pos)
+    else:
+        scene = get_castle_scene(ground=not TERRAIN)
+        meshes = [compile_mesh(scene)]
+        world = SurfaceGrid(scene)
+        stream = None
+        if TERRAIN:
+            terrain = Terrain()
+            world = CombinedWorld([world, terrain])
+    backend = RASTER_BACKEND if np is not None else "polygon"
+    zbuf = ZBuffer() if np is not None else None
+    pool = RenderPool(RENDER_WORKERS) if RENDER_WORKERS > 0 and np else None
+    mario = Instance(compile_mesh(get_mario_model()), state.pos)
+    instances = [mario]
+    scaler = ResolutionScaler() if DYNAMIC_RESOLUTION else None
+    coherence = FrameCoherence() if FRAME_COHERENCE else None
+    impostors = ImpostorCache() if IMPOSTORS else None
+    saver = SaveWriter(save_dir)
+    next_save = time.perf_counter() + AUTOSAVE_INTERVAL
     pygame.mouse.set_visible(False)
     pygame.event.set_grab(True)
     running = True
+    prof = None
     while running:
         dt = clock.tick(60) / 1000.0
+        work_start = time.perf_counter()
+        if prof is not None:
+            prof.begin()
         for e in pygame.event.get():
             if e.type == pygame.QUIT:
                 running = False
             if e.type == pygame.VIDEORESIZE:
                 W, H = e.w, e.h
                 screen = pygame.display.set_mode((W, H), pygame.RESIZABLE)
+                clear_backgrounds()
+                clear_views()
             if e.type == pygame.KEYDOWN and e.key == pygame.K_ESCAPE:
                 running = False
+            if e.type == pygame.KEYDOWN and e.key == pygame.K_F2 and zbuf is not None:
+                backend = "zbuffer" if backend == "polygon" else "polygon"
+            if e.type == pygame.KEYDOWN and e.key == pygame.K_F3:
+                if prof is None:
+                    prof = FrameProfiler()
+                    prof.begin()
+                else:
+                    prof = None
+            if e.type == pygame.KEYDOWN and e.key == pygame.K_F5:
+                scaler = ResolutionScaler() if scaler is None else None
+            if e.type == pygame.KEYDOWN and e.key == pygame.K_F4 and prof is not None:
+                stamp = time.strftime("%Y%m%d-%H%M%S")
+                prof.export_csv("profile-%s.csv" % stamp)
+                prof.export_trace("profile-%s.json" % stamp)
+        if prof is not None:
+            prof.mark("events")
         mx, my = pygame.mouse.get_rel()
         cam_rot[1] -= mx * CAM_TURN
         cam_rot[0] -= my * CAM_TURN
         cam_rot[0] = max(PITCH_MIN, min(PITCH_MAX, cam_rot[0]))
         pygame.mouse.set_pos((W // 2, H // 2))
-        keys = pygame.key.get_pressed()
-        yaw = cam_rot[1]
-        cy, sy = math.cos(yaw), math.sin(yaw)
-        move_speed = CAM_SPEED * dt
-        if keys[pygame.K_w]:
-            target_pos[0] -= sy * move_speed
-            target_pos[2] -= cy * move_speed
-        if keys[pygame.K_s]:
-            target_pos[0] += sy * move_speed
-            target_pos[2] += cy * move_speed
-        if keys[pygame.K_a]:
-            target_pos[0] -= cy * move_speed
-            target_pos[2] += sy * move_speed
-        if keys[pygame.K_d]:
-            target_pos[0] += cy * move_speed
-            target_pos[2] -= sy * move_speed
-        on_ground = target_pos[1] <= GROUND_Y + 0.01
-        if keys[pygame.K_SPACE] and on_ground:
-            vy = JUMP_VELOCITY
-        vy += GRAVITY * dt
-        target_pos[1] += vy * dt
-        if target_pos[1] <= GROUND_Y:
-            target_pos[1] = GROUND_Y
-            vy = 0.0
-        cam_pos = orbit_camera_pos(target_pos, cam_rot[1], cam_rot[0], CAM_DISTANCE)
-        draw_sky(screen)
-        to_draw = []
-        for tri_list, color in scene:
-            for tri in tri_list:
-                proj_z = []
-                for p in tri:
-                    q = project(p, cam_pos, cam_rot)
-                    if q is None:
-                        break
-                    proj_z.append(q[2])
-                if len(proj_z) == 3:
-                    to_draw.append((tri, color, sum(proj_z) / 3))
-        for tri_list, color in get_mario_tris(target_pos):
-            for tri in tri_list:
-                proj_z = []
-                for p in tri:
-                    q = project(p, cam_pos, cam_rot)
-                    if q is None:
-                        break
-                    proj_z.append(q[2])
-                if len(proj_z) == 3:
-                    to_draw.append((tri, color, sum(proj_z) / 3))
-        to_draw.sort(key=lambda x: -x[2])
-        for (tri, color, _) in to_draw:
-            draw_tri(screen, tri, color, cam_pos, cam_rot)
+        move = read_move_keys(pygame.key.get_pressed())
+        steps = sim.advance(dt)
+        if stream is not None:
+            stream.update(state.pos)
+            meshes = stream.meshes()
+            if not stream.ready_at(state.pos):
+                steps = 0  # hold Mario until the ground under him has streamed in
+        for _ in range(steps):
+            prev, state = state, step(state, move + (cam_rot[1],), sim.dt, world)
+        if level_path is None:
+            save.pos = tuple(state.pos)
+        if work_start >= next_save:
+            saver.save(slot, save)
+            next_save = work_start + AUTOSAVE_INTERVAL
+        if prof is not None:
+            prof.mark("sim")
+        mario.place(lerp_pos(prev.pos, state.pos, sim.alpha))
+        info = render_frame(screen, meshes, instances, mario.pos, cam_rot, backend, zbuf, prof, pool,
+                            scaler.scale if scaler is not None else 1.0, terrain, coherence, impostors)
+        if scaler is not None:
+            res = "3D %d%%" % round(scaler.scale * 100)
+            info = res if info is None else res + "  " + info
+        draw_hud(screen, info)
+        if prof is not None:
+            prof.mark("hud")
+            draw_profiler_overlay(screen, prof)
+            prof.mark("overlay")
+        pygame.display.flip()
+        if prof is not None:
+            prof.mark("flip")
+            prof.end()
+        if scaler is not None:
+            scaler.update(time.perf_counter() - work_start)
+    saver.save(slot, save)
+    saver.close()
+    if stream is not None:
+        stream.close()
+    if pool is not None:
+        pool.shutdown()
+    if zbuf is not None:
+        zbuf.close()
+    shutdown()
+
+# --- Headless benchmark ---
+def print_report(rep):
+    ft = rep["frame_ms"]
+    print("frames %d  fps %.1f  workers %d  gil %s" % (rep["frames"], rep["fps"], rep.get("workers", 0),
+                                                      "on" if rep.get("gil", True) else "off"))
+    print("frame ms  mean %.2f  p50 %.2f  p90 %.2f  p99 %.2f  max %.2f" % (
+        ft["mean"], ft["p50"], ft["p90"], ft["p99"], ft["max"]))
+    tr = rep["tris_per_frame"]
+    print("tris/frame  submitted %.0f  culled %.0f  drawn %.0f" % (
+        tr.get("submitted", 0), tr.get("culled", 0), tr.get("drawn", 0)))
+    if rep.get("reused"):
+        print("frames reused  %d" % rep["reused"])
+    if tr.get("impostors"):
+        print("impostors/frame %.1f  tris %.0f  baked %d" % (tr["impostors"], tr.get("impostored", 0),
+                                                             rep.get("impostors_baked", 0)))
+    for k, v in rep["stage_ms"].items():
+        print("  %-10s %7.3f ms  %5.1f%%" % (k, v, 100.0 * v / max(1e-9, ft["mean"])))
+
+def scripted_inputs(frame):
+    """Deterministic WASD/jump pattern for benchmark frames: walk, strafe, jump."""
+    phase = (frame // 90) % 4
+    return (phase in (0, 1), phase == 3, False, phase == 1, frame % 45 == 0)
+
+def scripted_batch_inputs(frame, n):
+    """scripted_inputs() plus a yaw for n Marios, each offset in time and heading."""
+    if np is None:
+        return [scripted_inputs(frame + 37 * i) + (0.61 * i,) for i in range(n)]
+    f = np.arange(n) * 37 + frame
+    phase = (f // 90) % 4
+    return np.column_stack((phase <= 1, phase == 3, np.zeros(n, dtype=bool), phase == 1, f % 45 == 0,
+                            np.arange(n) * 0.61))
+
+def benchmark(frames=600, copies=1, backend="polygon", size=(960, 720), dt=1.0 / 60, workers=0, trace=None,
+              csv=None, scale=1.0, coins=0, terrain=False, idle=0):
+    """Run the game frame loop headless with scripted camera/Mario paths and a fixed dt.
+    coins > 0 adds that many spinning coin instances in a grid around the spawn point;
+    terrain swaps the ground slabs for a Terrain. idle > 0 holds camera and Mario still for
+    that many frames out of every 120, to measure FrameCoherence reuse."""
+    global W, H
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    pygame.init()
+    W, H = size
+    screen = pygame.display.set_mode((W, H))
+    scene = replicate_scene(get_castle_scene(ground=not terrain), copies)
+    level = compile_mesh(scene)
+    world = SurfaceGrid(scene)
+    terrain = Terrain() if terrain else None
+    if terrain is not None:
+        world = CombinedWorld([world, terrain])
+    zbuf = ZBuffer() if np is not None else None
+    if zbuf is None:
+        backend = "polygon"
+    pool = RenderPool(workers) if workers > 0 and zbuf is not None else None
+    state = prev = MarioState()
+    mario = Instance(compile_mesh(get_mario_model()), state.pos)
+    coin = compile_mesh(get_coin_model())
+    side = max(1, math.ceil(math.sqrt(coins)))
+    instances = [mario] + [Instance(coin, (2.0 * (i % side - side // 2), GROUND_Y + 0.5, -2.0 * (i // side) - 4.0))
+                           for i in range(coins)]
+    cam_rot = [0.0, 0.0]
+    sim = FixedStep()
+    coherence = FrameCoherence() if FRAME_COHERENCE else None
+    impostors = ImpostorCache() if IMPOSTORS else None
+    prof = FrameProfiler(history=None)
+    for frame in range(frames):
+        prof.begin()
+        pygame.event.pump()
+        prof.mark("events")
+        if frame % 120 >= idle:
+            t = frame * dt
+            cam_rot[1] = 0.35 * t
+            cam_rot[0] = 0.2 + 0.25 * math.sin(0.5 * t)
+            move = scripted_inputs(frame)
+            for _ in range(sim.advance(dt)):
+                prev, state = state, step(state, move + (cam_rot[1],), sim.dt, world)
+            mario.place(lerp_pos(prev.pos, state.pos, sim.alpha))
+            for inst in instances[1:]:
+                inst.place(inst.pos, 3.0 * t)
+        prof.mark("sim")
+        render_frame(screen, [level], instances, mario.pos, cam_rot, backend, zbuf, prof, pool, scale, terrain,
+                     coherence, impostors)
         draw_hud(screen)
+        prof.mark("hud")
         pygame.display.flip()
-    pygame.quit()
+        prof.mark("flip")
+        prof.end()
+    if pool is not None:
+        pool.shutdown()
+    if zbuf is not None:
+        zbuf.close()
+    shutdown()
+    if trace:
+        prof.export_trace(trace)
+    if csv:
+        prof.export_csv(csv)
+    rep = prof.report()
+    rep.update({"copies": copies, "backend": backend, "size": list(size), "tris": len(level.tris),
+                "workers": workers if pool is not None else 0, "gil": gil_enabled(), "scale": scale,
+                "coins": coins, "terrain": terrain is not None, "idle": idle,
+                "reused": coherence.reused if coherence is not None else 0,
+                "impostors_baked": impostors.baked if impostors is not None else 0})
+    return rep
+
+def sim_benchmark(n=1024, steps=600, world="terrain", workers=0, dt=1.0 / SIM_HZ):
+    """Step a SimBatch of n Marios with scripted inputs, no pygame or rendering involved.
+    world is "flat" (GROUND_Y), "terrain" (a bare Terrain) or "castle" (the game's world)."""
+    if world == "castle":
+        scene = get_castle_scene(ground=not TERRAIN)
+        w = CombinedWorld([SurfaceGrid(scene), Terrain()]) if TERRAIN else SurfaceGrid(scene)
+    else:
+        w = Terrain() if world == "terrain" else None
+    batch = SimBatch(n, w, workers)
+    start = time.perf_counter()
+    for frame in range(steps):
+        batch.step(scripted_batch_inputs(frame, n), dt)
+    elapsed = time.perf_counter() - start
+    batch.close()
+    return {"instances": n, "steps": steps, "world": world, "workers": batch.workers,
+            "vectorised": batch.vectorised, "seconds": elapsed, "steps_per_s": n * steps / elapsed,
+            "realtime_x": n * steps * dt / elapsed}
 
 if __name__ == "__main__":
-    run()
+    parser = argparse.ArgumentParser(description="Cat's ! SM64")
+    parser.add_argument("--bench", action="store_true", help="run the headless renderer benchmark and exit")
+    parser.add_argument("--frames", type=int, default=600)
+    parser.add_argument("--copies", type=int, default=1, help="replicate get_castle_scene() N times")
+    parser.add_argument("--backend", choices=("polygon", "zbuffer"), default=RASTER_BACKEND)
+    parser.add_argument("--size", type=int, nargs=2, default=(W, H), metavar=("W", "H"))
+    parser.add_argument("--json", help="also write the report to this file")
+    parser.add_argument("--trace", help="write per-frame stage spans as Chrome-trace JSON")
+    parser.add_argument("--csv", help="write per-frame stage timings as CSV")
+    parser.add_argument("--coins", type=int, default=0, help="spinning coin instances added to the benchmark")
+    parser.add_argument("--terrain", action="store_true", help="benchmark with the quadtree terrain as ground")
+    parser.add_argument("--scale", type=float, default=1.0, help="fixed 3D render scale for the benchmark")
+    parser.add_argument("--idle", type=int, default=0, help="benchmark frames per 120 with camera and Mario held still")
+    parser.add_argument("--no-coherence", action="store_true", help="always redraw the 3D pass, even when nothing moved")
+    parser.add_argument("--no-impostors", action="store_true", help="draw distant objects as full geometry")
+    parser.add_argument("--workers", type=int, default=RENDER_WORKERS,
+                        help="parallel render threads, or --simulate processes (0 = off)")
+    parser.add_argument("--simulate", type=int, metavar="N",
+                        help="step N headless Marios for --frames steps (no pygame needed) and exit")
+    parser.add_argument("--sim-world", choices=("flat", "terrain", "castle"), default="terrain")
+    parser.add_argument("--level", help="play a binary level file, streamed from disk")
+    parser.add_argument("--save-dir", default=SAVE_DIR, help="directory holding the save slot files")
+    parser.add_argument("--build-level", metavar="PATH", help="write get_castle_scene() x --copies as a level file")
+    args = parser.parse_args()
+    FRAME_COHERENCE = not args.no_coherence
+    IMPOSTORS = not args.no_impostors
+    if args.build_level:
+        save_level(args.build_level, replicate_scene(get_castle_scene(), args.copies))
+    elif args.simulate:
+        report = sim_benchmark(args.simulate, args.frames, args.sim_world, args.workers)
+        print("%d Marios x %d steps on %s (%s): %.2f s  %.0f steps/s  %.0fx real time" % (
+            report["instances"], report["steps"], report["world"],
+            "NumPy" if report["vectorised"] else "%d workers" % report["workers"],
+            report["seconds"], report["steps_per_s"], report["realtime_x"]))
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=2)
+    elif pygame is None:
+        parser.error("pygame is needed to play or --bench; only --simulate and --build-level run without it")
+    elif args.bench:
+        report = benchmark(args.frames, args.copies, args.backend, tuple(args.size), workers=args.workers,
+                           trace=args.trace, csv=args.csv, scale=args.scale, coins=args.coins,
+                           terrain=args.terrain, idle=args.idle)
+        print_report(report)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=2)
+    else:
+        RENDER_WORKERS = args.workers
+        run(args.level, args.save_dir)
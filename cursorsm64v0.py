@@ -1,49 +1,211 @@
 import pygame
+import argparse
+import json
 import math
+import os
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # Configuration
 W, H = 960, 720
 FOV = 60
 NEAR, FAR = 0.1, 1000
+GUARD_BAND = 4000  # px beyond the viewport that near-clipped polygons are cut to
 CAM_SPEED = 20.0  # Units per second
 CAM_TURN = 0.15
 VERSION = "v0.2.1 (Fixed & Enhanced)"
+USE_NUMPY = True  # Batched vertex transform; False (or no NumPy) uses per-vertex to_view()/project_view()
 
-def project(v, cam_pos, cam_rot, scale=1.0):
+def to_view(v, cam_pos, cam_rot):
+    """World point to view space: x right, y up, z depth along the view direction."""
     x, y, z = v[0] - cam_pos[0], v[1] - cam_pos[1], v[2] - cam_pos[2]
     cy, sy = math.cos(cam_rot[1]), math.sin(cam_rot[1])
     x, z = x * cy + z * sy, -x * sy + z * cy
     cx, sx = math.cos(cam_rot[0]), math.sin(cam_rot[0])
     y, z = y * cx - z * sx, y * sx + z * cx
-    if z <= NEAR:
-        return None
+    return (x, y, z)
+
+def project_view(p, scale=1.0):
+    x, y, z = p
     f = (W * 0.5) / math.tan(math.radians(FOV * 0.5)) / z * scale
     return (W * 0.5 + x * f, H * 0.5 - y * f, z)
 
-def draw_tri(surf, pts, color, cam_pos, cam_rot):
-    proj = []
-    for p in pts:
-        q = project(p, cam_pos, cam_rot)
-        if q is None:
-            return
-        proj.append(q)
-    a, b, c = pts[0], pts[1], pts[2]
+def clip_near(a, b, c):
+    """Clip a view-space triangle to z >= NEAR; returns the polygon left (0, 3 or 4 points)."""
+    poly = []
+    for p, q in ((a, b), (b, c), (c, a)):
+        if p[2] >= NEAR:
+            poly.append(p)
+        if (p[2] >= NEAR) != (q[2] >= NEAR):
+            t = (NEAR - p[2]) / (q[2] - p[2])
+            poly.append((p[0] + (q[0] - p[0]) * t, p[1] + (q[1] - p[1]) * t, NEAR))
+    return poly if len(poly) >= 3 else []
+
+def clip_guard_band(poly, w, h):
+    """Cut a projected polygon [(x, y, depth)] to a w x h viewport plus GUARD_BAND pixels on
+    each side. pygame.draw.polygon's cost follows a polygon's extent, not its visible area,
+    and a triangle clipped at NEAR can reach hundreds of thousands of pixels. New vertices
+    interpolate 1/depth, which is linear on screen."""
+    for axis, bound, upper in ((0, -GUARD_BAND, False), (0, w + GUARD_BAND, True),
+                               (1, -GUARD_BAND, False), (1, h + GUARD_BAND, True)):
+        if len(poly) < 3:
+            return []
+        out = []
+        prev = poly[-1]
+        prev_in = prev[axis] <= bound if upper else prev[axis] >= bound
+        for p in poly:
+            p_in = p[axis] <= bound if upper else p[axis] >= bound
+            if p_in != prev_in:
+                t = (bound - prev[axis]) / (p[axis] - prev[axis])
+                iz = 1.0 / prev[2] + (1.0 / p[2] - 1.0 / prev[2]) * t
+                out.append((prev[0] + (p[0] - prev[0]) * t, prev[1] + (p[1] - prev[1]) * t, 1.0 / iz))
+            if p_in:
+                out.append(p)
+            prev, prev_in = p, p_in
+        poly = out
+    return poly if len(poly) >= 3 else []
+
+def queue_clipped(to_draw, a, b, c, fill, edge):
+    """Queue a view-space triangle that crosses NEAR as the 1 or 2 triangles in front of it,
+    each cut to the guard band and queued as one convex polygon. The pieces keep their
+    triangle's sort depth, so the painter's order is the same as without the cut."""
+    poly = [project_view(p) for p in clip_near(a, b, c)]
+    for i in range(1, len(poly) - 1):
+        tri = (poly[0], poly[i], poly[i + 1])
+        piece = clip_guard_band(tri, W, H)
+        if piece:
+            to_draw.append(((tri[0][2] + tri[1][2] + tri[2][2]) / 3, [p[:2] for p in piece], fill, edge))
+
+def face_normal(a, b, c):
     ab = (b[0]-a[0], b[1]-a[1], b[2]-a[2])
     ac = (c[0]-a[0], c[1]-a[1], c[2]-a[2])
-    nx = ab[1]*ac[2] - ab[2]*ac[1]
-    ny = ab[2]*ac[0] - ab[0]*ac[2]
-    nz = ab[0]*ac[1] - ab[1]*ac[0]
-    view = (cam_pos[0]-a[0], cam_pos[1]-a[1], cam_pos[2]-a[2])
-    if nx*view[0] + ny*view[1] + nz*view[2] <= 0:
-        return
-    ps = [(p[0], p[1]) for p in proj]
+    return (ab[1]*ac[2] - ab[2]*ac[1], ab[2]*ac[0] - ab[0]*ac[2], ab[0]*ac[1] - ab[1]*ac[0])
+
+def shade_colors(color, nz):
     nz = max(-1, min(1, nz * 0.01))
     shade = max(0.35, min(1.0, 0.65 + nz))
     r = int(min(255, color[0] * shade))
     g = int(min(255, color[1] * shade))
     b = int(min(255, color[2] * shade))
-    pygame.draw.polygon(surf, (r, g, b), ps)
-    pygame.draw.polygon(surf, (min(255, r+35), min(255, g+35), min(255, b+35)), ps, 1)
+    return (r, g, b), (min(255, r+35), min(255, g+35), min(255, b+35))
+
+class Mesh:
+    """Indexed triangles: shared vertices plus per-face normal, plane offset and shaded colours.
+
+    Arrays are NumPy when the batched vertex stage is on, plain lists otherwise.
+    """
+
+    def __init__(self, verts, tris, normals, plane_d, fills, edges):
+        self.verts = verts
+        self.tris = tris
+        self.normals = normals
+        self.plane_d = plane_d
+        self.fills = fills
+        self.edges = edges
+        self.vectorised = np is not None and not isinstance(verts, list)
+
+def compile_mesh(scene):
+    """Weld the (tri_list, color) entries of a scene into one Mesh, baking normals and flat shade."""
+    index = {}
+    verts, tris, normals, plane_d, fills, edges = [], [], [], [], [], []
+    for tri_list, color in scene:
+        for tri in tri_list:
+            ids = []
+            for p in tri:
+                i = index.get(p)
+                if i is None:
+                    i = index[p] = len(verts)
+                    verts.append(p)
+                ids.append(i)
+            n = face_normal(*tri)
+            fill, edge = shade_colors(color, n[2])
+            tris.append(tuple(ids))
+            normals.append(n)
+            plane_d.append(n[0]*tri[0][0] + n[1]*tri[0][1] + n[2]*tri[0][2])
+            fills.append(fill)
+            edges.append(edge)
+    if USE_NUMPY and np is not None:
+        return Mesh(np.array(verts, dtype=np.float32).reshape(-1, 3), np.array(tris, dtype=np.int32).reshape(-1, 3),
+                    np.array(normals, dtype=np.float32).reshape(-1, 3), np.array(plane_d, dtype=np.float32),
+                    fills, edges)
+    return Mesh(verts, tris, normals, plane_d, fills, edges)
+
+def project_all(verts, cam_pos, cam_rot, scale=1.0):
+    """to_view() + project_view() for an (N, 3) array in one pass: screen x, screen y, depth and visibility mask."""
+    rel = verts - np.asarray(cam_pos, dtype=np.float32)
+    cy, sy = math.cos(cam_rot[1]), math.sin(cam_rot[1])
+    x = rel[:, 0] * cy + rel[:, 2] * sy
+    z = -rel[:, 0] * sy + rel[:, 2] * cy
+    cx, sx = math.cos(cam_rot[0]), math.sin(cam_rot[0])
+    y = rel[:, 1] * cx - z * sx
+    z = rel[:, 1] * sx + z * cx
+    visible = z > NEAR
+    f = (W * 0.5) / math.tan(math.radians(FOV * 0.5)) * scale / np.where(visible, z, 1.0)
+    return W * 0.5 + x * f, H * 0.5 - y * f, z, visible
+
+def collect_mesh(mesh, cam_pos, cam_rot, to_draw, stats=None):
+    """Project each unique vertex once and queue front-facing, in-front triangles as (depth, pts, fill, edge)."""
+    queued = len(to_draw)
+    _collect_mesh(mesh, cam_pos, cam_rot, to_draw)
+    if stats is not None:
+        stats["submitted"] += len(mesh.tris)
+        stats["drawn"] += len(to_draw) - queued
+
+def _collect_mesh(mesh, cam_pos, cam_rot, to_draw):
+    fills, edges = mesh.fills, mesh.edges
+    if mesh.vectorised:
+        # Backfaces go first, so only vertices of front-facing triangles get projected.
+        idx = np.flatnonzero(mesh.normals @ np.asarray(cam_pos, dtype=np.float32) > mesh.plane_d)
+        tris = mesh.tris[idx]
+        n = len(mesh.verts)
+        used = np.zeros(n, bool)
+        used[tris.ravel()] = True
+        vsel = np.flatnonzero(used)
+        sx, sy, z = np.zeros(n, np.float32), np.zeros(n, np.float32), np.zeros(n, np.float32)
+        visible = np.zeros(n, bool)
+        sx[vsel], sy[vsel], z[vsel], visible[vsel] = project_all(mesh.verts[vsel], cam_pos, cam_rot)
+        vis = visible[tris]
+        whole = vis.all(axis=1)
+        for t in np.flatnonzero(vis.any(axis=1) & ~whole).tolist():
+            a, b, c = (to_view(v, cam_pos, cam_rot) for v in mesh.verts[tris[t]].tolist())
+            queue_clipped(to_draw, a, b, c, fills[idx[t]], edges[idx[t]])
+        idx, tris = idx[whole], tris[whole]
+        pts = np.stack((sx, sy), axis=1)[tris].tolist()
+        depth = z[tris].mean(axis=1).tolist()
+        for i, ps, d in zip(idx.tolist(), pts, depth):
+            to_draw.append((d, ps, fills[i], edges[i]))
+        return
+    # View-space and screen positions are filled in lazily, only for front-facing triangles.
+    view = [None] * len(mesh.verts)
+    proj = [None] * len(mesh.verts)
+    cx, cy, cz = cam_pos
+    for t, ids in enumerate(mesh.tris):
+        n = mesh.normals[t]
+        if n[0]*cx + n[1]*cy + n[2]*cz <= mesh.plane_d[t]:
+            continue
+        for q in ids:
+            if view[q] is None:
+                view[q] = to_view(mesh.verts[q], cam_pos, cam_rot)
+                if view[q][2] > NEAR:
+                    proj[q] = project_view(view[q])
+        i, j, k = ids
+        a, b, c = proj[i], proj[j], proj[k]
+        if a is None or b is None or c is None:
+            queue_clipped(to_draw, view[i], view[j], view[k], fills[t], edges[t])
+            continue
+        to_draw.append(((a[2] + b[2] + c[2]) / 3, [a[:2], b[:2], c[:2]], fills[t], edges[t]))
+
+def sort_queued(to_draw):
+    to_draw.sort(key=lambda x: -x[0])
+
+def draw_queued(surf, to_draw):
+    for _, ps, fill, edge in to_draw:
+        pygame.draw.polygon(surf, fill, ps)
+        pygame.draw.polygon(surf, edge, ps, 1)
 
 def box_tris(cx, cy, cz, w, h, d):
     hw, hh, hd = w/2, h/2, d/2
@@ -91,6 +253,39 @@ def get_castle_scene():
         scene.append((box_tris(-15, i*2, 15, s, 2, s), green))
     return scene
 
+# --- Cached backgrounds ---
+_backgrounds = {}
+
+def gradient_background(size, top, bottom):
+    """Vertical gradient Surface for (size, palette), rendered once and reused every frame."""
+    key = (size, top, bottom)
+    surf = _backgrounds.get(key)
+    if surf is None:
+        w, h = size
+        surf = pygame.Surface(size)
+        for y in range(h + 1):
+            t = y / max(1, h)
+            pygame.draw.line(surf, tuple(max(0, min(255, int(a + (b - a) * t))) for a, b in zip(top, bottom)),
+                             (0, y), (w, y))
+        _backgrounds[key] = surf
+    return surf
+
+def clear_backgrounds():
+    _backgrounds.clear()
+
+def draw_sky(screen):
+    screen.blit(gradient_background((W, H), (135, 206, 235), (135, 206, 235)), (0, 0))
+
+def replicate_scene(scene, copies, spacing=240.0):
+    """Tile `copies` translated copies of a scene on a square grid (copy 0 stays in place)."""
+    side = max(1, math.ceil(math.sqrt(copies)))
+    out = []
+    for n in range(copies):
+        ox, oz = (n % side) * spacing, (n // side) * spacing
+        for tri_list, color in scene:
+            out.append(([tuple((p[0] + ox, p[1], p[2] + oz) for p in tri) for tri in tri_list], color))
+    return out
+
 def draw_hud(screen):
     font = pygame.font.Font(None, 28)
     t = font.render("WASD move | SPACE/LSHIFT up/down | ESC quit", True, (220, 220, 220))
@@ -111,6 +306,46 @@ def draw_menu(screen):
 
     # ... rest unchanged
 
+def move_camera(cam_pos, cam_rot, move, dt):
+    """Fly-camera movement; move is (fwd, back, left, right, up, down)."""
+    fwd, back, left, right, up, down = move
+    cy, sy = math.cos(cam_rot[1]), math.sin(cam_rot[1])
+    move_speed = CAM_SPEED * dt
+    
+    if fwd: 
+        cam_pos[0] += cy * move_speed
+        cam_pos[2] -= sy * move_speed
+    if back: 
+        cam_pos[0] -= cy * move_speed
+        cam_pos[2] += sy * move_speed
+    if left: 
+        cam_pos[0] -= sy * move_speed
+        cam_pos[2] -= cy * move_speed
+    if right: 
+        cam_pos[0] += sy * move_speed
+        cam_pos[2] += cy * move_speed
+    if up: cam_pos[1] += move_speed
+    if down: cam_pos[1] -= move_speed
+    
+    # Simple ground clamp
+    if cam_pos[1] < 2.0:
+        cam_pos[1] = 2.0
+
+def render_frame(screen, level, cam_pos, cam_rot, prof=None):
+    draw_sky(screen)
+    if prof is not None:
+        prof.mark("sky")
+    to_draw = []
+    collect_mesh(level, cam_pos, cam_rot, to_draw, prof.counts if prof is not None else None)
+    if prof is not None:
+        prof.mark("transform")
+    sort_queued(to_draw)
+    if prof is not None:
+        prof.mark("sort")
+    draw_queued(screen, to_draw)
+    if prof is not None:
+        prof.mark("raster")
+
 def main():
     global W, H
     pygame.init()
@@ -125,6 +360,7 @@ def main():
     cam_rot = [0.0, 0.0]
     
     scene = get_castle_scene()
+    level = compile_mesh(scene)
     
     pygame.mouse.set_visible(False)
     pygame.event.set_grab(True)
@@ -138,6 +374,7 @@ def main():
             if e.type == pygame.VIDEORESIZE:
                 W, H = e.w, e.h
                 screen = pygame.display.set_mode((W, H), pygame.RESIZABLE)
+                clear_backgrounds()
             if e.type == pygame.KEYDOWN and e.key == pygame.K_ESCAPE:
                 running = False
 
@@ -151,49 +388,122 @@ def main():
 
         # Movement
         keys = pygame.key.get_pressed()
-        cy, sy = math.cos(cam_rot[1]), math.sin(cam_rot[1])
-        move_speed = CAM_SPEED * dt
-        
-        if keys[pygame.K_w]: 
-            cam_pos[0] += cy * move_speed
-            cam_pos[2] -= sy * move_speed
-        if keys[pygame.K_s]: 
-            cam_pos[0] -= cy * move_speed
-            cam_pos[2] += sy * move_speed
-        if keys[pygame.K_a]: 
-            cam_pos[0] -= sy * move_speed
-            cam_pos[2] -= cy * move_speed
-        if keys[pygame.K_d]: 
-            cam_pos[0] += sy * move_speed
-            cam_pos[2] += cy * move_speed
-        if keys[pygame.K_SPACE]: cam_pos[1] += move_speed
-        if keys[pygame.K_LSHIFT]: cam_pos[1] -= move_speed
-        
-        # Simple ground clamp
-        if cam_pos[1] < 2.0:
-            cam_pos[1] = 2.0
+        move_camera(cam_pos, cam_rot, (keys[pygame.K_w], keys[pygame.K_s], keys[pygame.K_a], keys[pygame.K_d],
+                                       keys[pygame.K_SPACE], keys[pygame.K_LSHIFT]), dt)
 
         # Render 3D scene
-        screen.fill((135, 206, 235))
-        to_draw = []
-        for tri_list, color in scene:
-            for tri in tri_list:
-                proj_z = []
-                for p in tri:
-                    q = project(p, cam_pos, cam_rot)
-                    if q is None:
-                        break
-                    proj_z.append(q[2])
-                if len(proj_z) == 3:
-                    to_draw.append((tri, color, sum(proj_z) / 3))
-        to_draw.sort(key=lambda x: -x[2])
-        for (tri, color, _) in to_draw:
-            draw_tri(screen, tri, color, cam_pos, cam_rot)
+        render_frame(screen, level, cam_pos, cam_rot)
 
         draw_hud(screen)
         pygame.display.flip()
 
     pygame.quit()
 
+# Headless benchmark
+class FrameProfiler:
+    """Wall-clock time per game-loop stage plus triangle counters, one record per frame."""
+
+    def __init__(self):
+        self.frames = []
+        self.stages = {}
+        self.counts = {}
+        self._start = self._last = 0.0
+
+    def begin(self):
+        self.stages = {}
+        self.counts = {"submitted": 0, "drawn": 0}
+        self._start = self._last = time.perf_counter()
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.stages[stage] = self.stages.get(stage, 0.0) + now - self._last
+        self._last = now
+
+    def end(self):
+        self.frames.append((self._last - self._start, self.stages, self.counts))
+
+    def report(self):
+        times = sorted(f[0] for f in self.frames)
+        n = max(1, len(times))
+
+        def pct(q):
+            return times[min(len(times) - 1, int(q * len(times)))] * 1000.0 if times else 0.0
+
+        total = sum(times) or 1.0
+        stages = {}
+        for _, st, _ in self.frames:
+            for k, v in st.items():
+                stages[k] = stages.get(k, 0.0) + v
+        counts = {}
+        for _, _, c in self.frames:
+            for k, v in c.items():
+                counts[k] = counts.get(k, 0) + v
+        counts["culled"] = counts.get("submitted", 0) - counts.get("drawn", 0)
+        return {
+            "frames": len(self.frames),
+            "fps": n / total,
+            "frame_ms": {"mean": total / n * 1000.0, "p50": pct(0.5), "p90": pct(0.9), "p99": pct(0.99),
+                         "max": times[-1] * 1000.0 if times else 0.0},
+            "tris_per_frame": {k: v / n for k, v in counts.items()},
+            "stage_ms": {k: v / n * 1000.0 for k, v in stages.items()},
+        }
+
+def print_report(rep):
+    ft = rep["frame_ms"]
+    print("frames %d  fps %.1f" % (rep["frames"], rep["fps"]))
+    print("frame ms  mean %.2f  p50 %.2f  p90 %.2f  p99 %.2f  max %.2f" % (
+        ft["mean"], ft["p50"], ft["p90"], ft["p99"], ft["max"]))
+    tr = rep["tris_per_frame"]
+    print("tris/frame  submitted %.0f  culled %.0f  drawn %.0f" % (
+        tr.get("submitted", 0), tr.get("culled", 0), tr.get("drawn", 0)))
+    for k, v in rep["stage_ms"].items():
+        print("  %-10s %7.3f ms  %5.1f%%" % (k, v, 100.0 * v / max(1e-9, ft["mean"])))
+
+def benchmark(frames=600, copies=1, size=(960, 720), dt=1.0 / 60):
+    """Fly the camera along a scripted path with a fixed dt, headless, and report frame stats."""
+    global W, H
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    pygame.init()
+    W, H = size
+    screen = pygame.display.set_mode((W, H))
+    level = compile_mesh(replicate_scene(get_castle_scene(), copies))
+    cam_pos = [0.0, 2.0, 40.0]
+    cam_rot = [0.0, 0.0]
+    prof = FrameProfiler()
+    for frame in range(frames):
+        prof.begin()
+        pygame.event.pump()
+        prof.mark("events")
+        t = frame * dt
+        cam_rot[1] = 0.4 * t
+        cam_rot[0] = 0.15 * math.sin(0.7 * t)
+        phase = (frame // 120) % 4
+        move_camera(cam_pos, cam_rot, (phase == 0, phase == 2, phase == 1, phase == 3, phase == 1, phase == 3), dt)
+        prof.mark("camera")
+        render_frame(screen, level, cam_pos, cam_rot, prof)
+        draw_hud(screen)
+        prof.mark("hud")
+        pygame.display.flip()
+        prof.mark("flip")
+        prof.end()
+    pygame.quit()
+    rep = prof.report()
+    rep.update({"copies": copies, "size": list(size), "tris": len(level.tris)})
+    return rep
+
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Cat's ! SM64 free-fly viewer")
+    parser.add_argument("--bench", action="store_true", help="run the headless renderer benchmark and exit")
+    parser.add_argument("--frames", type=int, default=600)
+    parser.add_argument("--copies", type=int, default=1, help="replicate get_castle_scene() N times")
+    parser.add_argument("--size", type=int, nargs=2, default=(W, H), metavar=("W", "H"))
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+    if args.bench:
+        report = benchmark(args.frames, args.copies, tuple(args.size))
+        print_report(report)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=2)
+    else:
+        main()